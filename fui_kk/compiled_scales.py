@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compiled scales.json, with the lookups every consumer needs prepared.
+
+scales.json maps each question to order/all/ignore lists. course.py,
+web_reports.py and plot_courses.py used to derive reversed orders, ranks
+and chart colors from these lists again for every course (and for stats,
+every answer). A CompiledScales is built once per scales.json and kept for
+the rest of the process, keyed by the hash of the file.
+"""
+
+__authors__    = ["Ole Herman Schumacher Elgesem"]
+__copyright__  = "Ole Herman Schumacher Elgesem"
+__license__    = "MIT"
+# This file is subject to the terms and conditions defined in
+# file 'LICENSE.txt', which is part of this source code package.
+
+from collections import OrderedDict
+
+from file_funcs import load_json, path_clean, hash_file
+
+# Chart colors by number of answers in the order list, best answer first:
+CHART_COLORS = {
+    9: ['#21428c', '#4573b8', '#7c81be', '#a8bfd5', '#c2b59b', '#e2dda6', '#aad58f', '#f7a21c', '#bf2026'],
+    7: ['#21428c', '#4573b8', '#a8bfd5', '#c2b59b', '#e2dda6', '#f7a21c', '#bf2026'],
+    6: ['#21428c', '#4573b8', '#a8bfd5', '#c2b59b', '#f7a21c', '#bf2026'],
+    5: ['#21428c', '#4573b8', '#c2b59b', '#f7a21c', '#bf2026'],
+}
+
+class QuestionScale:
+    """The scale of one question.
+
+    order/ignore/all are the lists from scales.json. ranked_order is order
+    reversed, so the index of an answer in it is its rank (0 is the worst
+    answer), rank maps answers to that index and ignore_set is for fast
+    membership tests. colors is None if there is no palette for the number
+    of answers.
+    """
+    def __init__(self, scale):
+        self.order = list(scale.get("order", []))
+        self.ignore = list(scale.get("ignore", []))
+        self.all = list(scale.get("all", []))
+        self.ranked_order = tuple(reversed(self.order))
+        self.rank = {}
+        for rank, answer in enumerate(self.ranked_order):
+            self.rank.setdefault(answer, rank)
+        self.ignore_set = frozenset(self.ignore)
+        self.colors = CHART_COLORS.get(len(self.order))
+        self.colors_js = None
+        if self.colors is not None:
+            self.colors_js = "[{}]".format(", ".join("'{}'".format(c) for c in self.colors))
+
+class CompiledScales:
+    """question -> QuestionScale, read-only."""
+    def __init__(self, scales):
+        self._questions = OrderedDict()
+        for question, scale in scales.items():
+            self._questions[question] = QuestionScale(scale)
+
+    def __getitem__(self, question):
+        return self._questions[question]
+
+    def __contains__(self, question):
+        return question in self._questions
+
+    def __iter__(self):
+        return iter(self._questions)
+
+    def __len__(self):
+        return len(self._questions)
+
+    def keys(self):
+        return self._questions.keys()
+
+    def items(self):
+        return self._questions.items()
+
+def compile_scales(scales):
+    """Compile a scales dict, compiled scales are returned as they are."""
+    if isinstance(scales, CompiledScales):
+        return scales
+    return CompiledScales(scales)
+
+# Compiled scales loaded by this process, by path and sha1:
+_loaded = {}
+
+def load_compiled_scales(scales_path):
+    """Load scales.json compiled, only once per process while it is unchanged."""
+    key = (path_clean(scales_path), hash_file(path_clean(scales_path)))
+    if key not in _loaded:
+        _loaded[key] = CompiledScales(load_json(scales_path))
+    return _loaded[key]
@@ -11,9 +11,90 @@ import os
 import sys
 from bs4 import BeautifulSoup
 import json
+import argparse
+import hashlib
+import numpy
 from collections import OrderedDict
-from file_funcs import dump_json, load_json, path_join
+from file_funcs import (load_json, path_join, load_fresh_columns,
+                        ColumnStore, dump_json_if_changed, load_json_cache,
+                        cache_path, optional_fingerprint, call_job,
+                        run_jobs)
 from language import determine_language
+from compiled_scales import compile_scales, load_compiled_scales
+
+COURSE_NAMES_PATH = "./resources/course_names/all.json"
+
+class CourseStatsError(Exception):
+    pass
+
+def encode_answers(answers):
+    """Dictionary encode a list of answers.
+
+    Returns the distinct answers in the order first seen, and the list of
+    codes (indices into it) for all answers."""
+    vocabulary = OrderedDict()
+    codes = [vocabulary.setdefault(a, len(vocabulary)) for a in answers]
+    return list(vocabulary), codes
+
+def question_codes(responses, question):
+    if isinstance(responses, ColumnStore) and responses.is_scaled(question):
+        return responses.vocabulary(question), responses.codes(question)
+    if isinstance(responses, ColumnStore):
+        return encode_answers(responses.answers(question))
+    return encode_answers(responses[question])
+
+def response_questions(responses):
+    # The column store has every question, free text included, so questions
+    # added to scales.json after the responses were parsed still get stats:
+    return list(responses)
+
+def question_stats(question, vocabulary, codes, scale):
+    """Counts, average and average text of one question.
+
+    The answers are given as integer codes into vocabulary, scale is a
+    compiled QuestionScale. Ranks and the ignore test are looked up once per
+    distinct answer, after that counting and the rank sum are single numpy
+    passes over the codes.
+    """
+    answer_order = scale.ranked_order
+    answer_ignore = scale.ignore_set
+    rank_of = scale.rank
+
+    size = len(vocabulary)
+    counts_array = numpy.bincount(numpy.asarray(codes, dtype=numpy.intp),
+                                  minlength=size)
+    ranks = numpy.zeros(size, dtype=numpy.int64)
+    ranked = numpy.zeros(size, dtype=bool)
+    for i, answer in enumerate(vocabulary):
+        if answer in answer_ignore or counts_array[i] == 0:
+            continue
+        if answer not in rank_of:
+            raise ValueError('"{}" is neither in order nor ignore for "{}"'.format(
+                answer, question))
+        ranks[i] = rank_of[answer]
+        ranked[i] = True
+
+    ctr = int(counts_array[ranked].sum())
+    total = int(counts_array.dot(ranks))
+
+    counts = OrderedDict()
+    for i, answer in enumerate(vocabulary):
+        if counts_array[i] > 0:
+            counts[answer] = int(counts_array[i])
+    if ctr == 0:
+        average = "None"
+    else:
+        average = total/ctr
+    average_text = ""
+    if average != "None":
+        rounded = int(round(average, 0))
+        average_text = answer_order[rounded]
+
+    result = OrderedDict()
+    result["counts"] = counts
+    result["average"] = average
+    result["average_text"] = average_text
+    return result
 
 def generate_stats(responses, participation, scales, stats=None):
     if stats is None:
@@ -34,107 +115,256 @@ def generate_stats(responses, participation, scales, stats=None):
     stats["answer_percentage"] = percentage
 
     questions = OrderedDict()
+    scales = compile_scales(scales)
 
     language = None
 
-    for question in responses:
+    for question in response_questions(responses):
         if language is None:
             language = determine_language(question)
         if question in scales:
-            question_answers = responses[question]
-            answer_order = list(reversed(scales[question]["order"]))
-            answer_ignore = scales[question]["ignore"]
-            questions[question] = OrderedDict()
-
-            counts = OrderedDict()
-            total = 0;
-            ctr = 0;
-            for answer in question_answers:
-                if answer not in answer_ignore:
-                    ctr += 1
-                    total += answer_order.index(answer)
-                if answer in counts:
-                    counts[answer] += 1
-                else:
-                    counts[answer] = 1
-            if ctr == 0:
-                average = "None"
-            else:
-                average = total/ctr
-            delta = 1000
-            average_text = ""
-            if average != "None":
-                rounded = int(round(average, 0))
-                average_text = answer_order[rounded]
-            questions[question]["counts"] = counts
-            questions[question]["average"] = average
-            questions[question]["average_text"] = average_text
-
-            # max_people = 0
-            # most_common = []
-            # for c in counts:
-            #     if counts[c] > max_people:
-            #         most_common = [c]
-            #         max_people = counts[c]
-            #     elif counts[c] == max_people:
-            #         most_common.append(c)
-            # questions[question]["most_common_answer"] = OrderedDict()
-            # questions[question]["most_common_answer"]["text"] = most_common
-            # questions[question]["most_common_answer"]["people"] = max_people
-            # questions[question]["most_common_answer"]["percentage"] = max_people/answered
+            vocabulary, codes = question_codes(responses, question)
+            questions[question] = question_stats(question, vocabulary, codes,
+                                                 scales[question])
     stats["language"] = language
     stats["questions"] = questions
     return stats
 
 def generate_stats_file(responses_path, participation_path, output_path, scales, course):
-    responses = load_json(responses_path)
+    """Generate and write the stats for one course.
+
+    Returns the questions of the course (the stats depend on their entries
+    in scales) and whether the stats file was written, it is not for
+    courses without answers.
+    """
+    responses = load_fresh_columns(responses_path)
+    if responses is None:
+        responses = load_json(responses_path)
     participation = load_json(participation_path)
+    try:
+        questions = response_questions(responses)
+        stats = course_stats(responses, participation, scales, course)
+    finally:
+        if isinstance(responses, ColumnStore):
+            responses.close()
+    if not stats:
+        return questions, False
+    dump_json_if_changed(stats, output_path)
+    return questions, True
+
+def course_stats(responses, participation, scales, course):
+    """generate_stats for a course, with the course info first.
+
+    Returns None for courses with 0 answers, raises CourseStatsError if the
+    language can't be detected.
+    """
     stats = OrderedDict()
     stats["course"] = course
     stats = generate_stats(responses, participation, scales, stats)
     if not stats:
         print("Skipping course with 0 answers:")
         print(json.dumps(course, indent=2))
-        return
+        return None
     if not stats["language"]:
-        print("Unable to detect language in course:")
-        print(json.dumps(course, indent=2))
-        print("This most likely means that the questions have changed and need to be added to scales.json")
-        sys.exit(1)
+        raise CourseStatsError("Unable to detect language in course:\n" +
+            json.dumps(course, indent=2) + "\nThis most likely means that the"
+            " questions have changed and need to be added to scales.json."
+            "\nAfter changing scales.json, run responses.py (make responses)"
+            " again before generating stats")
+    return stats
 
-    dump_json(stats, output_path)
+def scales_digest(scales, questions):
+    """Hash of the parts of scales that stats for these questions use."""
+    scales = compile_scales(scales)
+    used = []
+    for question in questions:
+        if question in scales:
+            used.append([question, scales[question].order,
+                         scales[question].ignore])
+        else:
+            used.append([question, None])
+    text = json.dumps(used, ensure_ascii=False)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def stats_up_to_date(entry, inputs, scales, output_path):
+    """Compare the inputs a stats file was built from with the current ones.
+
+    inputs holds the course info and the fingerprints of the responses and
+    participation files; scales only counts for the questions of the course.
+    """
+    if entry is None or entry.get("course") != inputs["course"]:
+        return False
+    for key in ("responses", "participation"):
+        if inputs[key] is None or (entry.get(key) or {}).get("sha1") != inputs[key]["sha1"]:
+            return False
+    if entry.get("scales") != scales_digest(scales, entry.get("questions", [])):
+        return False
+    return not entry.get("written") or os.path.exists(output_path)
+
+def course_info(course_code, course_names, semester_name):
+    course = OrderedDict()
+    try:
+        course_name = course_names[course_code]
+    except KeyError:
+        course_name = "Unknown"
+        print("Warning: could not find name for course " + course_code)
+    course["code"] = course_code
+    course["name"] = course_name
+    course["semester"] = semester_name
+    return course
+
+def semester_filenames(responses_dir):
+    return sorted(f for f in os.listdir(responses_dir) if ".json" in f)
 
 def generate_stats_dir(responses_dir, participation_dir, output_dir, scales, course_names, semester_name):
-    for filename in os.listdir(responses_dir):
-        if ".json" in filename:
-            course = OrderedDict()
-            course_code = os.path.splitext(filename)[0]
-            try:
-                course_name = course_names[course_code]
-            except KeyError:
-                course_name = "Unknown"
-                print("Warning: could not find name for course " + course_code)
-            course["code"] = course_code
-            course["name"] = course_name
-            course["semester"] = semester_name
-            responses_path = path_join(responses_dir,filename)
-            participation_path = path_join(participation_dir,filename)
-            output_path = path_join(output_dir, filename)
-            generate_stats_file(responses_path, participation_path, output_path, scales, course)
+    for filename in semester_filenames(responses_dir):
+        course_code = os.path.splitext(filename)[0]
+        course = course_info(course_code, course_names, semester_name)
+        responses_path = path_join(responses_dir,filename)
+        participation_path = path_join(participation_dir,filename)
+        output_path = path_join(output_dir, filename)
+        generate_stats_file(responses_path, participation_path, output_path, scales, course)
 
 def generate_stats_semester(semester_path, semester_name):
     scales_path = semester_path+"/outputs/scales.json"
-    scales = load_json(scales_path)
-    course_names = load_json("./resources/course_names/all.json")
+    scales = load_compiled_scales(scales_path)
+    course_names = load_json(COURSE_NAMES_PATH)
     generate_stats_dir(semester_path+"/outputs/responses",
                        semester_path+"/downloads/participation",
                        semester_path+"/outputs/stats",
                        scales, course_names, semester_name)
 
-if __name__ == '__main__':
-    if len(sys.argv) == 1 or not os.path.isdir(sys.argv[1]):
+# Per worker process state, see init_worker:
+_semester_scales = {}
+
+def init_worker():
+    _semester_scales.clear()
+
+def get_semester_scales(semester_path):
+    if semester_path not in _semester_scales:
+        _semester_scales[semester_path] = load_compiled_scales(semester_path+"/outputs/scales.json")
+    return _semester_scales[semester_path]
+
+def generate_stats_job(job):
+    """Worker function for one course, returns the questions of the course
+    and whether its stats were written, see run_jobs."""
+    semester_path, filename, course = job
+    scales = get_semester_scales(semester_path)
+    return generate_stats_file(
+        path_join(semester_path, "outputs/responses", filename),
+        path_join(semester_path, "downloads/participation", filename),
+        path_join(semester_path, "outputs/stats", filename),
+        scales, course)
+
+def plan_semester(semester_path, course_names, force=False):
+    """Find the courses of a semester whose stats are out of date.
+
+    The manifest (.cache/stats.json) maps each course file to the
+    fingerprints of the responses and participation files, the course info,
+    the questions of the course and a digest of their scales. Returns the
+    jobs and the new manifest, with entries for up to date courses only.
+    """
+    semester_name = os.path.basename(semester_path)
+    scales = load_compiled_scales(semester_path+"/outputs/scales.json")
+    manifest = OrderedDict()
+    if not force:
+        manifest = load_json_cache(cache_path(semester_path, "stats"))
+    new_manifest = OrderedDict()
+    jobs = []
+    inputs_by_file = {}
+    for filename in semester_filenames(semester_path+"/outputs/responses"):
+        course_code = os.path.splitext(filename)[0]
+        course = course_info(course_code, course_names, semester_name)
+        entry = manifest.get(filename, {})
+        inputs = OrderedDict()
+        inputs["course"] = course
+        inputs["responses"] = optional_fingerprint(
+            path_join(semester_path, "outputs/responses", filename),
+            entry.get("responses"))
+        inputs["participation"] = optional_fingerprint(
+            path_join(semester_path, "downloads/participation", filename),
+            entry.get("participation"))
+        output_path = path_join(semester_path, "outputs/stats", filename)
+        if stats_up_to_date(manifest.get(filename), inputs, scales, output_path):
+            new_manifest[filename] = entry
+            new_manifest[filename].update(inputs)
+            continue
+        jobs.append((semester_path, filename, course))
+        inputs_by_file[filename] = inputs
+    return jobs, new_manifest, scales, inputs_by_file
+
+def generate_stats_semesters(semester_dirs, processes=1,
+                             course_names_path=COURSE_NAMES_PATH, force=False):
+    """Generate stats for every out of date course in every semester, on a
+    process pool when processes > 1. Errors are reported per course (or
+    per semester, if it can't be planned, e.g. without scales.json) at the
+    end, returns the number of failed courses and semesters."""
+    course_names = load_json(course_names_path)
+    semester_errors = []
+    jobs = []
+    plans = OrderedDict()
+    for semester_path in sorted(semester_dirs):
+        responses_dir = semester_path+"/outputs/responses"
+        if not os.path.isdir(responses_dir):
+            print("Warning: skipping {}, '{}' doesn't exist".format(semester_path, responses_dir))
+            continue
+        plan, error = call_job(plan_semester, semester_path, course_names, force)
+        if error is not None:
+            semester_errors.append((semester_path, error))
+            continue
+        semester_jobs, manifest, scales, inputs = plan
+        plans[semester_path] = (manifest, scales, inputs)
+        jobs.extend(semester_jobs)
+
+    # Courses of the same semester are kept together, so each worker loads a
+    # semester's scales.json only a few times:
+    chunksize = max(1, len(jobs) // (max(1, processes) * 4))
+    results = run_jobs(generate_stats_job, jobs, processes, initializer=init_worker,
+                       chunksize=chunksize, expected=(CourseStatsError,))
+
+    errors = []
+    for job, (result, error) in zip(jobs, results):
+        semester_path, filename, course = job
+        if error is not None:
+            errors.append((job, error))
+            continue
+        questions, written = result
+        manifest, scales, inputs = plans[semester_path]
+        entry = OrderedDict(inputs[filename])
+        entry["questions"] = questions
+        entry["scales"] = scales_digest(scales, questions)
+        entry["written"] = written
+        manifest[filename] = entry
+
+    for semester_path, (manifest, scales, inputs) in plans.items():
+        manifest = OrderedDict(sorted(manifest.items()))
+        dump_json_if_changed(manifest, cache_path(semester_path, "stats"))
+
+    for semester_path, error in semester_errors:
+        print("Error: could not generate stats for {}:".format(semester_path))
+        print(error)
+    for (semester_path, filename, course), error in errors:
+        print("Error: could not generate stats for {} in {}:".format(
+            filename, semester_path))
+        print(error)
+    return len(errors) + len(semester_errors)
+
+def get_args():
+    argparser = argparse.ArgumentParser(
+                description = "Generate stats for all semesters in a directory")
+    argparser.add_argument("directory", help="Data dir, with one dir per semester", type=str)
+    argparser.add_argument("--jobs", "-j", default=os.cpu_count() or 1,
+                           help="Number of worker processes", type=int)
+    argparser.add_argument("--force", "-f", action="store_true",
+                           help="Rebuild all stats, even if they are up to date")
+    args = argparser.parse_args()
+    if not os.path.isdir(args.directory):
         sys.exit("Must specify dir")
-    directory = sys.argv[1]
+    return args
+
+if __name__ == '__main__':
+    args = get_args()
+    directory = args.directory
     semester_dirs = []
     for (root, dirs, files) in os.walk(directory):
         for d in dirs:
@@ -144,5 +374,6 @@ if __name__ == '__main__':
                 os.makedirs(path_join(root,d,"inputs","md"), exist_ok=True)
                 os.makedirs(path_join(root,d,"inputs","tex"), exist_ok=True)
         break
-    for d in semester_dirs:
-        generate_stats_semester(d, os.path.basename(d))
+    failed = generate_stats_semesters(semester_dirs, args.jobs, force=args.force)
+    if failed:
+        sys.exit("Error: stats for {} course(s) or semester(s) could not be generated".format(failed))
@@ -10,10 +10,12 @@ __license__    = "MIT"
 
 import os
 import sys
+import argparse
 from bs4 import BeautifulSoup
 from collections import OrderedDict
 import json
-from file_funcs import dump_json, load_json
+from file_funcs import (dump_json, load_json, path_join, path_clean,
+                        dump_json_if_changed, load_json_cache, file_fingerprint)
 
 def get_semester_order(start_year, stop_year):
     start_year = int(start_year)
@@ -28,21 +30,232 @@ def get_semesters(path):
     semester_order = get_semester_order(2000,2030)
     semesters = []
     for root, subdirs, files in os.walk(path):
-        semesters = list(filter(lambda x: x != ".git", subdirs))
+        semesters = list(filter(lambda x: x in semester_order, subdirs))
         break
 
     indices = [semester_order.index(x) for x in semesters]
     semesters = [x for (y,x) in sorted(zip(indices,semesters))]
     return semesters
 
-if __name__ == '__main__':
-    semesters = get_semesters("./data")
+def merge_semesters(semesters):
+    """Combine (semester code, semester courses) pairs, in semester order,
+    into course code -> semester code -> course data."""
     courses = OrderedDict()
-    for s in semesters:
-        p = "./data/"+s+"/outputs/courses.json"
-        semester = load_json(p)
+    for s, semester in semesters:
         for course in semester:
             if course not in courses:
                 courses[course] = OrderedDict()
             courses[course][s] = semester[course]
-    dump_json(courses, "./data/courses.json")
+    return courses
+
+def load_semesters(path):
+    for s in get_semesters(path):
+        yield s, load_json(path+"/"+s+"/outputs/courses.json")
+
+def semester_sort_key(semester):
+    semester_order = get_semester_order(2000,2030)
+    if semester in semester_order:
+        return semester_order.index(semester)
+    return len(semester_order)
+
+def semester_range(first, last, data_dir="./data"):
+    """Semesters in data_dir from first to last (inclusive), in order."""
+    start = semester_sort_key(first)
+    stop = semester_sort_key(last)
+    return [s for s in get_semesters(data_dir)
+            if start <= semester_sort_key(s) <= stop]
+
+# The course history (course code -> semester -> course data) is stored in
+# data/.history, one json file per course plus index.json. The index maps
+# every course to its semesters, and every semester to the fingerprint of
+# the outputs/courses.json it was last merged from.
+def history_dir(data_dir):
+    return path_join(data_dir, ".history")
+
+def history_index_path(data_dir):
+    return path_join(history_dir(data_dir), "index.json")
+
+def history_shard_path(data_dir, course_code):
+    return path_join(history_dir(data_dir), "courses", course_code + ".json")
+
+def write_shard(data_dir, course_code, course):
+    path = history_shard_path(data_dir, course_code)
+    if course:
+        dump_json_if_changed(course, path)
+    elif os.path.exists(path_clean(path)):
+        os.remove(path_clean(path))
+
+def new_index():
+    index = OrderedDict()
+    index["semesters"] = OrderedDict()
+    index["courses"] = OrderedDict()
+    return index
+
+def sorted_index(index):
+    index["semesters"] = OrderedDict(sorted(index["semesters"].items(),
+                                            key=lambda x: semester_sort_key(x[0])))
+    index["courses"] = OrderedDict(sorted(index["courses"].items()))
+    return index
+
+def update_history(data_dir, force=False):
+    """Merge the courses.json of changed semesters into the history shards.
+
+    Only the shards of courses in added, changed or removed semesters are
+    read and rewritten. Returns the number of semesters merged.
+    """
+    index = new_index() if force else load_json_cache(history_index_path(data_dir))
+    if "semesters" not in index or "courses" not in index:
+        index = new_index()
+    old_semesters = index["semesters"]
+    new_semesters = OrderedDict()
+    changed = OrderedDict()
+    for s in get_semesters(data_dir):
+        path = path_join(data_dir, s, "outputs/courses.json")
+        if not os.path.exists(path):
+            continue
+        entry = old_semesters.get(s)
+        fingerprint = file_fingerprint(path, entry)
+        if entry and entry.get("sha1") == fingerprint["sha1"]:
+            new_semesters[s] = entry
+            new_semesters[s].update(fingerprint)
+            continue
+        semester = load_json(path)
+        fingerprint["courses"] = list(semester.keys())
+        new_semesters[s] = fingerprint
+        changed[s] = semester
+
+    removed = [s for s in old_semesters if s not in new_semesters]
+    affected = set()
+    for s in list(changed) + removed:
+        affected.update(old_semesters.get(s, {}).get("courses", []))
+        affected.update(changed.get(s, {}).keys())
+
+    for course_code in sorted(affected):
+        course = OrderedDict()
+        if course_code in index["courses"]:
+            course = load_json(history_shard_path(data_dir, course_code))
+        for s in removed + list(changed):
+            course.pop(s, None)
+        for s, semester in changed.items():
+            if course_code in semester:
+                course[s] = semester[course_code]
+        course = OrderedDict(sorted(course.items(), key=lambda x: semester_sort_key(x[0])))
+        write_shard(data_dir, course_code, course)
+        if course:
+            index["courses"][course_code] = list(course.keys())
+        else:
+            index["courses"].pop(course_code, None)
+
+    index["semesters"] = new_semesters
+    dump_json_if_changed(sorted_index(index), history_index_path(data_dir))
+    return len(changed) + len(removed)
+
+def semester_fingerprints(data_dir, semesters):
+    """Index entries for semesters whose history comes from their
+    outputs/courses.json as it is now, for write_history."""
+    fingerprints = OrderedDict()
+    for s in semesters:
+        path = path_join(data_dir, s, "outputs/courses.json")
+        fingerprint = file_fingerprint(path)
+        fingerprint["courses"] = list(load_json(path).keys())
+        fingerprints[s] = fingerprint
+    return fingerprints
+
+def write_history(courses, data_dir, semester_fingerprints=None):
+    """Replace the whole history with courses (course code -> semester ->
+    course data), only shards whose content changed are rewritten.
+
+    semester_fingerprints (see semester_fingerprints()) should cover every
+    semester in courses, otherwise the next update_history merges those
+    semesters again from their courses.json."""
+    old_index = load_json_cache(history_index_path(data_dir))
+    index = new_index()
+    if semester_fingerprints:
+        index["semesters"].update(semester_fingerprints)
+    for course_code, course in courses.items():
+        write_shard(data_dir, course_code, course)
+        index["courses"][course_code] = list(course.keys())
+    for course_code in old_index.get("courses", {}):
+        if course_code not in courses:
+            write_shard(data_dir, course_code, None)
+    dump_json_if_changed(sorted_index(index), history_index_path(data_dir))
+
+class CourseHistory:
+    """Read-only, lazy view of the course history.
+
+    Only the index is read up front, a course's shard is loaded the first
+    time it is asked for.
+    """
+    def __init__(self, data_dir="./data"):
+        self.data_dir = data_dir
+        self._index = load_json(history_index_path(data_dir))["courses"]
+        self._loaded = {}
+
+    def __contains__(self, course_code):
+        return course_code in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, course_code):
+        if course_code not in self._index:
+            raise KeyError(course_code)
+        if course_code not in self._loaded:
+            self._loaded[course_code] = load_json(history_shard_path(self.data_dir, course_code))
+        return self._loaded[course_code]
+
+    def get(self, course_code, default=None):
+        if course_code in self:
+            return self[course_code]
+        return default
+
+    def semesters(self, course_code):
+        """The semesters of a course, without loading its shard."""
+        return list(self._index.get(course_code, []))
+
+    def keys(self):
+        return self._index.keys()
+
+    def items(self):
+        for course_code in self._index:
+            yield course_code, self[course_code]
+
+    def values(self):
+        for course_code in self._index:
+            yield self[course_code]
+
+    def load(self, course_codes=None):
+        """course code -> semester -> data for some (default: all) courses."""
+        if course_codes is None:
+            course_codes = self._index
+        courses = OrderedDict()
+        for course_code in course_codes:
+            if course_code in self:
+                courses[course_code] = self[course_code]
+        return courses
+
+def load_history(data_dir="./data"):
+    """The course history, lazily from the shards when they exist, otherwise
+    from data/courses.json (as written before the history was sharded)."""
+    if os.path.exists(history_index_path(data_dir)):
+        return CourseHistory(data_dir)
+    return load_json(path_join(data_dir, "courses.json"))
+
+def get_args():
+    argparser = argparse.ArgumentParser(
+                description = "Update the course history from all semesters' courses.json")
+    argparser.add_argument("--data", "-d", default="./data", help="Data dir", type=str)
+    argparser.add_argument("--force", "-f", action="store_true",
+                           help="Rebuild the whole history")
+    argparser.add_argument("--combined", "-c", action="store_true",
+                           help="Also write the whole history to data/courses.json")
+    return argparser.parse_args()
+
+if __name__ == '__main__':
+    args = get_args()
+    update_history(args.data, args.force)
+    if args.combined:
+        dump_json(CourseHistory(args.data).load(), path_join(args.data, "courses.json"))
@@ -14,6 +14,12 @@ __license__    = "MIT"
 import os
 import sys
 import json
+import hashlib
+import traceback
+import multiprocessing
+import mmap
+import struct
+from array import array
 from collections import OrderedDict
 import io
 
@@ -48,3 +54,334 @@ def load_json(path):
     except json.decoder.JSONDecodeError as err:
         print("ERROR: The file '{}' contains invalid json syntax: {}".format(path,err))
         sys.exit(1)
+
+def json_text(data):
+    return json.dumps(data, indent=2, ensure_ascii=False)
+
+def write_if_changed(text, path):
+    """Write text (str or bytes) to path unless the file already has exactly
+    that content.
+
+    Returns True if the file was (re)written. Leaving identical files alone
+    keeps their mtime, so later steps don't see spurious changes.
+    """
+    path = path_clean(path)
+    encoded = text if isinstance(text, bytes) else text.encode("utf-8")
+    try:
+        with open(path, 'rb') as in_file:
+            if in_file.read() == encoded:
+                return False
+    except FileNotFoundError:
+        pass
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    with open(path, 'wb') as out_file:
+        out_file.write(encoded)
+    return True
+
+def dump_json_if_changed(data, path):
+    return write_if_changed(json_text(data), path)
+
+def load_json_cache(path):
+    """Like load_json, but a missing or broken cache file is just empty."""
+    try:
+        with open(path_clean(path), 'r', encoding="utf-8") as in_file:
+            return json.load(in_file, object_pairs_hook=OrderedDict)
+    except (FileNotFoundError, ValueError):
+        return OrderedDict()
+
+def cache_path(semester_path, name):
+    return path_join(semester_path, "outputs", ".cache", name + ".json")
+
+def hash_file(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(1 << 16), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def file_fingerprint(path, previous=None):
+    """Size, mtime and sha1 of a file.
+
+    The hash from a previous fingerprint is reused when size and mtime are
+    unchanged, so checking an untouched file doesn't read it.
+    """
+    stat = os.stat(path)
+    fingerprint = OrderedDict()
+    fingerprint["size"] = stat.st_size
+    fingerprint["mtime"] = stat.st_mtime_ns
+    if previous and previous.get("size") == fingerprint["size"] \
+                and previous.get("mtime") == fingerprint["mtime"] \
+                and "sha1" in previous:
+        fingerprint["sha1"] = previous["sha1"]
+    else:
+        fingerprint["sha1"] = hash_file(path)
+    return fingerprint
+
+def optional_fingerprint(path, previous=None):
+    """file_fingerprint, or None if the file doesn't exist."""
+    try:
+        return file_fingerprint(path, previous)
+    except FileNotFoundError:
+        return None
+
+def call_job(func, *args, expected=()):
+    """(func(*args), None), or (None, error message) if it raised or exited.
+
+    Exceptions of the expected types are reported by their message, others
+    with a traceback. sys.exit (load_json exits on missing or broken files)
+    is caught too, so one broken input doesn't stop the rest of a run.
+    """
+    try:
+        return func(*args), None
+    except expected as e:
+        return None, str(e)
+    except SystemExit as e:
+        # load_json has already printed what went wrong
+        return None, "exited with status {}".format(e.code)
+    except Exception:
+        return None, traceback.format_exc()
+
+def _call_job(call):
+    func, job, expected = call
+    return call_job(func, job, expected=expected)
+
+def run_jobs(func, jobs, processes=1, initializer=None, initargs=(),
+             chunksize=1, expected=()):
+    """call_job(func, job) for every job, on a process pool if processes > 1.
+
+    initializer(*initargs) sets up the per worker process state, it is
+    called in this process when there is no pool. Returns a list of
+    (result, error message or None) in the order of jobs.
+    """
+    processes = max(1, min(processes, len(jobs)))
+    calls = [(func, job, expected) for job in jobs]
+    if processes > 1:
+        with multiprocessing.Pool(processes, initializer=initializer,
+                                  initargs=initargs) as pool:
+            return pool.map(_call_job, calls, chunksize=chunksize)
+    if initializer is not None:
+        initializer(*initargs)
+    return [_call_job(call) for call in calls]
+
+# Columnar response store, a compact binary alternative to the responses json.
+# It holds every question of a course and is the only copy of the free text
+# answers, the responses json only has the scaled questions.
+# Layout: magic, header length (uint32), json header, then 8-byte aligned
+# blocks. A scaled question is an array of small int codes into its
+# vocabulary, a free text question is an array of n+1 uint64 offsets into a
+# utf-8 blob. All numbers are little endian, block offsets in the header are
+# relative to the end of the (padded) header.
+COLUMNS_MAGIC = b"FUIKKCOL"
+COLUMNS_VERSION = 1
+
+def _align(n):
+    return (n + 7) & ~7
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+def dump_columns(responses, scaled_questions, path):
+    """Write responses (question -> answers) as a column store.
+
+    Questions in scaled_questions are dictionary encoded, everything else is
+    stored as free text. Returns True if the file was (re)written.
+    """
+    columns = []
+    blocks = []
+    position = 0
+    respondents = 0
+    for question, answers in responses.items():
+        respondents = max(respondents, len(answers))
+        column = OrderedDict()
+        column["question"] = question
+        if question in scaled_questions:
+            vocabulary = OrderedDict()
+            codes = [vocabulary.setdefault(a, len(vocabulary)) for a in answers]
+            if len(vocabulary) <= 0xff:
+                typecode = "B"
+            elif len(vocabulary) <= 0xffff:
+                typecode = "H"
+            else:
+                typecode = "I"
+            data = _little_endian(array(typecode, codes))
+            column["kind"] = "scaled"
+            column["vocabulary"] = list(vocabulary)
+            column["typecode"] = typecode
+            column["offset"] = position
+            column["count"] = len(answers)
+            blocks.append(data)
+            position = _align(position + len(data))
+        else:
+            encoded = [a.encode("utf-8") for a in answers]
+            offsets = array("Q", [0])
+            total = 0
+            for e in encoded:
+                total += len(e)
+                offsets.append(total)
+            data = _little_endian(offsets)
+            column["kind"] = "text"
+            column["offsets"] = position
+            column["count"] = len(answers)
+            blocks.append(data)
+            position = _align(position + len(data))
+            column["data"] = position
+            column["length"] = total
+            blocks.append(b"".join(encoded))
+            position = _align(position + total)
+        columns.append(column)
+
+    header = OrderedDict()
+    header["version"] = COLUMNS_VERSION
+    header["respondents"] = respondents
+    header["columns"] = columns
+    header = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    start = _align(len(COLUMNS_MAGIC) + 4 + len(header))
+
+    parts = [COLUMNS_MAGIC, struct.pack("<I", len(header)), header]
+    parts.append(b"\0" * (start - len(COLUMNS_MAGIC) - 4 - len(header)))
+    for block in blocks:
+        parts.append(block)
+        parts.append(b"\0" * (_align(len(block)) - len(block)))
+    return write_if_changed(b"".join(parts), path)
+
+class ColumnStore:
+    """Read-only, memory mapped view of a file written by dump_columns.
+
+    Nothing is decoded up front; codes() returns views straight into the
+    mapped file, and free text is only decoded when asked for.
+    """
+    def __init__(self, path):
+        self.path = path_clean(path)
+        with open(self.path, 'rb') as in_file:
+            self._map = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic_end = len(COLUMNS_MAGIC)
+        if self._map[0:magic_end] != COLUMNS_MAGIC:
+            self._map.close()
+            raise ValueError("'{}' is not a column store".format(self.path))
+        (length,) = struct.unpack("<I", self._map[magic_end:magic_end+4])
+        header = json.loads(self._map[magic_end+4:magic_end+4+length].decode("utf-8"),
+                            object_pairs_hook=OrderedDict)
+        if header["version"] != COLUMNS_VERSION:
+            self._map.close()
+            raise ValueError("'{}' has unsupported version {}".format(
+                self.path, header["version"]))
+        self._start = _align(magic_end + 4 + length)
+        self.respondents = header["respondents"]
+        self._columns = OrderedDict()
+        for column in header["columns"]:
+            self._columns[column["question"]] = column
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # Views from codes() are still alive, the map is closed
+            # when they are garbage collected.
+            pass
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __contains__(self, question):
+        return question in self._columns
+
+    def questions(self):
+        return list(self._columns)
+
+    def is_scaled(self, question):
+        return self._columns[question]["kind"] == "scaled"
+
+    def _array(self, typecode, offset, count):
+        start = self._start + offset
+        end = start + count * array(typecode).itemsize
+        view = memoryview(self._map)[start:end]
+        if sys.byteorder == "big":
+            values = array(typecode, view.tobytes())
+            values.byteswap()
+            return values
+        return view.cast(typecode)
+
+    def _text_offsets(self, column):
+        return self._array("Q", column["offsets"], column["count"] + 1)
+
+    def codes(self, question):
+        """Integer codes into vocabulary(question) for a scaled question."""
+        column = self._columns[question]
+        if column["kind"] != "scaled":
+            raise ValueError('"{}" is not a scaled question'.format(question))
+        return self._array(column["typecode"], column["offset"], column["count"])
+
+    def vocabulary(self, question):
+        """Distinct answers to a question, in the order first seen."""
+        column = self._columns[question]
+        if column["kind"] == "scaled":
+            return list(column["vocabulary"])
+        return list(OrderedDict.fromkeys(self.answers(question)))
+
+    def answers(self, question):
+        """All answers to a question, like the lists in the responses json."""
+        column = self._columns[question]
+        if column["kind"] == "scaled":
+            vocabulary = column["vocabulary"]
+            return [vocabulary[c] for c in self.codes(question)]
+        offsets = self._text_offsets(column)
+        start = self._start + column["data"]
+        blob = self._map[start:start + column["length"]]
+        return [blob[offsets[i]:offsets[i+1]].decode("utf-8")
+                for i in range(column["count"])]
+
+    def to_dict(self, questions=None):
+        if questions is None:
+            questions = self._columns
+        data = OrderedDict()
+        for question in questions:
+            data[question] = self.answers(question)
+        return data
+
+def load_columns(path):
+    return ColumnStore(path)
+
+def sibling_path(responses_path, folder_name, extension):
+    """outputs/responses/X.json -> outputs/<folder_name>/X<extension>"""
+    folder, filename = os.path.split(responses_path)
+    name = os.path.splitext(filename)[0]
+    return path_join(os.path.dirname(folder), folder_name, name + extension)
+
+def columns_path(responses_path):
+    return sibling_path(responses_path, "columns", ".columns")
+
+def scaled_responses(responses, scaled_questions):
+    """The scaled questions of question -> answers, for the responses json.
+
+    Free text is only kept in the column store, where stages that only need
+    scaled answers never decode it.
+    """
+    scaled = OrderedDict()
+    for question, answers in responses.items():
+        if question in scaled_questions:
+            scaled[question] = answers
+    return scaled
+
+def load_fresh_columns(responses_path):
+    """The column store written alongside a responses json, or None if it is
+    missing or older than the json."""
+    path = path_clean(columns_path(responses_path))
+    try:
+        if os.stat(path).st_mtime_ns < os.stat(path_clean(responses_path)).st_mtime_ns:
+            return None
+        return load_columns(path)
+    except (OSError, ValueError):
+        return None
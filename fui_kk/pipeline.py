@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Build the course history straight from the tsv files, in memory.
+
+This does the work of responses.py, course.py, semester.py and courses.py
+in one go: each tsv file is parsed once and the parsed structures are
+passed along without serializing them in between. Each semester's
+courses.json is always written, since the history index refers to it. The
+other intermediate files (responses, column stores and stats)
+are only written with --artifacts, --combined also writes the whole
+history to data/courses.json. scales.json has to be up
+to date for every semester, run scales.py first.
+"""
+
+__authors__    = ["Ole Herman Schumacher Elgesem"]
+__copyright__  = "Ole Herman Schumacher Elgesem"
+__license__    = "MIT"
+# This file is subject to the terms and conditions defined in
+# file 'LICENSE.txt', which is part of this source code package.
+
+import os
+import sys
+import argparse
+from collections import OrderedDict
+
+from file_funcs import (dump_json, load_json, path_join, dump_json_if_changed,
+                        dump_columns, columns_path, scaled_responses, call_job,
+                        run_jobs)
+from responses import (parse_course_tsv, find_tsv_files, output_path_for,
+                       init_csv_reader)
+from course import course_info, course_stats, CourseStatsError, COURSE_NAMES_PATH
+from semester import course_data_from_stats
+from compiled_scales import load_compiled_scales
+from courses import (get_semesters, merge_semesters, write_history,
+                     semester_fingerprints)
+
+def build_course(tsv_filename, semester_path, scales, course_names, artifacts=False):
+    """Semester course data for one tsv file, None for courses without answers."""
+    semester_name = os.path.basename(semester_path)
+    tsv_dir = path_join(semester_path, "downloads/tsv")
+    responses_path = output_path_for(tsv_filename, tsv_dir,
+                                     path_join(semester_path, "outputs/responses"))
+    filename = os.path.basename(responses_path)
+    participation_path = path_join(semester_path, "downloads/participation", filename)
+    if not os.path.exists(participation_path):
+        raise CourseStatsError("'{}' doesn't exist".format(participation_path))
+
+    responses = parse_course_tsv(tsv_filename)
+    scaled = scaled_responses(responses, scales)
+    participation = load_json(participation_path)
+    course = course_info(os.path.splitext(filename)[0], course_names, semester_name)
+    stats = course_stats(scaled, participation, scales, course)
+
+    if artifacts:
+        dump_json_if_changed(scaled, responses_path)
+        dump_columns(responses, scales, columns_path(responses_path))
+        if stats:
+            dump_json_if_changed(stats, path_join(semester_path, "outputs/stats", filename))
+    if not stats:
+        return None
+    return course["code"], course_data_from_stats(stats)
+
+def build_semester(semester_path, course_names, artifacts=False):
+    """Returns (semester data, list of (tsv file, error message))."""
+    scales = load_compiled_scales(semester_path+"/outputs/scales.json")
+    semester_data = OrderedDict()
+    errors = []
+    for tsv_filename in find_tsv_files(path_join(semester_path, "downloads/tsv")):
+        result, error = call_job(build_course, tsv_filename, semester_path,
+                                 scales, course_names, artifacts,
+                                 expected=(CourseStatsError,))
+        if error is not None:
+            errors.append((tsv_filename, error))
+            continue
+        if result:
+            course_code, course_data = result
+            semester_data[course_code] = course_data
+    # Always written, the history index refers to it (see write_history):
+    dump_json_if_changed(semester_data, semester_path+"/outputs/courses.json")
+    return semester_data, errors
+
+# Per worker process state, see init_worker:
+_course_names = None
+
+def init_worker(course_names_path):
+    global _course_names
+    init_csv_reader()
+    _course_names = load_json(course_names_path)
+
+def build_semester_job(job):
+    semester_path, artifacts = job
+    return build_semester(semester_path, _course_names, artifacts)
+
+def semester_source(semester_path):
+    """"tsv" if the semester can be built from tsv files, "courses" if only
+    its courses.json exists, otherwise None."""
+    if os.path.isdir(semester_path+"/downloads/tsv"):
+        if os.path.exists(semester_path+"/outputs/scales.json"):
+            return "tsv"
+        print("Warning: {} has no scales.json, run scales.py first".format(semester_path))
+    if os.path.exists(semester_path+"/outputs/courses.json"):
+        return "courses"
+    return None
+
+def build_all(data_dir, processes=1, artifacts=False,
+              course_names_path=COURSE_NAMES_PATH):
+    """Build the history of all semesters in data_dir.
+
+    Returns (course code -> semester -> course data, errors, semesters
+    included in the history). Every included semester's outputs/courses.json
+    holds its part of the history.
+    """
+    semesters = get_semesters(data_dir)
+    sources = OrderedDict()
+    for s in semesters:
+        source = semester_source(path_join(data_dir, s))
+        if source is None:
+            print("Warning: skipping {}, it has neither tsv files nor courses.json".format(s))
+            continue
+        sources[s] = source
+
+    jobs = [(path_join(data_dir, s), artifacts) for s, src in sources.items() if src == "tsv"]
+    results = run_jobs(build_semester_job, jobs, processes, initializer=init_worker,
+                       initargs=(course_names_path,))
+    built = OrderedDict()
+    for (semester_path, artifacts), (result, error) in zip(jobs, results):
+        if error is not None:
+            result = None, [(semester_path, error)]
+        built[semester_path] = result
+
+    semester_datas = []
+    errors = []
+    for s, source in sources.items():
+        semester_path = path_join(data_dir, s)
+        if source == "courses":
+            semester_datas.append((s, load_json(semester_path+"/outputs/courses.json")))
+            continue
+        semester_data, semester_errors = built[semester_path]
+        errors.extend(semester_errors)
+        if semester_data is not None:
+            semester_datas.append((s, semester_data))
+    included = [s for s, semester_data in semester_datas]
+    return merge_semesters(semester_datas), errors, included
+
+def get_args():
+    argparser = argparse.ArgumentParser(
+                description = "Build the course history from the tsv files in memory")
+    argparser.add_argument("--data", "-d", default="./data", help="Data dir", type=str)
+    argparser.add_argument("--artifacts", "-a", action="store_true",
+                           help="Also write responses and stats per semester")
+    argparser.add_argument("--combined", "-c", action="store_true",
+                           help="Also write the whole history to data/courses.json")
+    argparser.add_argument("--jobs", "-j", default=os.cpu_count() or 1,
+                           help="Number of worker processes", type=int)
+    return argparser.parse_args()
+
+def main():
+    args = get_args()
+    courses, errors, semesters = build_all(args.data, args.jobs, args.artifacts)
+    # With their fingerprints in the index, courses.py only merges these
+    # semesters again when their courses.json changes:
+    write_history(courses, args.data, semester_fingerprints(args.data, semesters))
+    if args.combined:
+        dump_json(courses, path_join(args.data, "courses.json"))
+    for path, error in errors:
+        print("Error: could not build {}:".format(path))
+        print(error)
+    if errors:
+        sys.exit("Error: {} course(s) or semester(s) failed".format(len(errors)))
+
+if __name__ == '__main__':
+    main()
@@ -29,18 +29,25 @@ __license__    = "MIT"
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
-import multiprocessing, pipes, os, re
+import pipes, os, re
 import matplotlib
 matplotlib.use('agg')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import json
 import sys
+import argparse
+import hashlib
 from collections import OrderedDict
 from functools import partial
 from copy import copy
 
-from file_funcs import dump_json, load_json, print_json
+from file_funcs import (dump_json, load_json, print_json, json_text,
+                        dump_json_if_changed, load_json_cache, cache_path,
+                        call_job, run_jobs)
 from language import determine_language
+from compiled_scales import load_compiled_scales
+from courses import load_history, semester_range
 
 
 def get_general_question(course_semester):
@@ -56,36 +63,30 @@ def get_general_question(course_semester):
     print("Cannot find general question: " + json.dumps(course_semester, indent=2))
     sys.exit(1)
 
-def plot_course(course_name, courses, output, scales, semester):
-    course = courses[course_name]
-    general_question = get_general_question(course[semester])
-
-    scale_text = list(reversed(scales[general_question]["order"]))
-    scale_val = list(range(len(scale_text)))
-
-    scale = scale_text
+def plot_course(course_name, courses, output, scales, semester, cached=None):
+    """Plot the general assessment history of a course up to semester.
 
-    semester_codes = list(course.keys())
-
-    # Filter out semesters which had a different question:
-    for semester_code in semester_codes:
-        if general_question not in course[semester_code]:
-            del course[semester_code]
-
-    if semester not in semester_codes:
+    Returns the plot's cache key, or None if there was nothing to plot. If
+    the key equals cached and the files exist, they are left untouched.
+    """
+    course = courses[course_name]
+    if semester not in course:
         print("Warning: the course {} doesn't have data for {}".format(course_name, semester))
-        return
-
-    semester_codes = list(course.keys())
-    semesters      = list(course.items())
+        return None
+    general_question = get_general_question(course[semester])
 
-    end_index      = semester_codes.index(semester)+1
-    semester_codes = semester_codes[0:end_index]
-    semesters      = semesters[0:end_index]
+    scale = list(scales[general_question].ranked_order)
 
+    # Leave out semesters which had a different question, and semesters
+    # after this one. The history itself is never modified:
+    semester_codes = []
     scores = []
-    for semester_code in semester_codes:
-        scores.append(course[semester_code][general_question]["average"])
+    for semester_code, course_semester in course.items():
+        if general_question in course_semester:
+            semester_codes.append(semester_code)
+            scores.append(course_semester[general_question]["average"])
+        if semester_code == semester:
+            break
 
     language = determine_language(general_question) # Defaults to None
 
@@ -93,45 +94,214 @@ def plot_course(course_name, courses, output, scales, semester):
                   "Generell vurdering fra") # Default to norwegian
     plot_title = "{} {}".format(plot_title, semester_codes[0])
 
-    fig = plt.figure(figsize=(10, 5), edgecolor='k')
-    plt.title(plot_title)
-
-    semester_nums = range(len(semester_codes))
-    plt.plot(semester_nums, scores, marker='o', markersize=5)
-
-    # Some space between between axis lines and points.
-    plt.xlim(-0.2, len(semester_nums) - 0.8)
-
-    # Semester codes along the x-axis.
-    plt.xticks(semester_nums, semester_codes)
-
-    # Rating descriptions along the y-axis
-    plt.ylim(-0.5, len(scale)-0.5)
-    plt.yticks(range(len(scale)), scale)
-
-    axis = plt.gca()
-    axis.yaxis.grid(True)
-    plt.subplots_adjust(left=0.2, right=0.8, top=0.9, bottom=0.1)
+    key = plot_key(semester_codes, scores, scale, language)
+    paths = [output+course_name+"."+fmt for fmt in PLOT_FORMATS]
+    if key == cached and all(os.path.exists(path) for path in paths):
+        return key
 
+    template = get_plot_template(scale)
+    template.update(plot_title, semester_codes, scores)
     print("Generated plot: " + output+course_name+'.pdf')
-    plt.savefig(output+course_name+'.pdf', format='pdf')
-    plt.savefig(output+course_name+'.png', format='png')
-    plt.close('all')
-
-def generate_plots(courses, scales, semester_name):
+    template.export(output+course_name, PLOT_FORMATS)
+    return key
+
+PLOT_FORMATS = ("pdf", "png")
+PLOT_VERSION = 1
+
+def plot_key(semester_codes, scores, scale, language):
+    """Hash of everything a course plot depends on."""
+    inputs = [PLOT_VERSION, list(PLOT_FORMATS), list(semester_codes),
+              list(scores), list(scale), language]
+    return hashlib.sha1(json_text(inputs).encode("utf-8")).hexdigest()
+
+class PlotTemplate:
+    """A styled figure for one scale layout (the y-axis labels).
+
+    The figure, axes, y-ticks and grid are only set up once, plotting a
+    course just swaps the title, x-axis and line data.
+    """
+    def __init__(self, scale):
+        self.fig = Figure(figsize=(10, 5), edgecolor='k')
+        FigureCanvasAgg(self.fig)
+        self.axis = self.fig.add_subplot(1, 1, 1)
+        self.title = self.axis.set_title("")
+        self.line, = self.axis.plot([], [], marker='o', markersize=5)
+
+        # Rating descriptions along the y-axis
+        self.axis.set_ylim(-0.5, len(scale)-0.5)
+        self.axis.set_yticks(range(len(scale)))
+        self.axis.set_yticklabels(scale)
+
+        self.axis.yaxis.grid(True)
+        self.fig.subplots_adjust(left=0.2, right=0.8, top=0.9, bottom=0.1)
+
+    def update(self, title, semester_codes, scores):
+        self.title.set_text(title)
+        semester_nums = range(len(semester_codes))
+        self.line.set_data(list(semester_nums), scores)
+
+        # Some space between between axis lines and points.
+        self.axis.set_xlim(-0.2, len(semester_nums) - 0.8)
+
+        # Semester codes along the x-axis.
+        self.axis.set_xticks(semester_nums)
+        self.axis.set_xticklabels(semester_codes)
+
+    def export(self, path, formats):
+        """Save the figure as path.<format> for each format."""
+        for fmt in formats:
+            self.fig.savefig(path+"."+fmt, format=fmt)
+
+# Per process, scale labels -> PlotTemplate:
+_plot_templates = {}
+
+def get_plot_template(scale):
+    key = tuple(scale)
+    if key not in _plot_templates:
+        _plot_templates[key] = PlotTemplate(scale)
+    return _plot_templates[key]
+
+def plot_shard(job):
+    """Worker function, plots the courses in one shard (course code ->
+    history) of a semester. Returns the new manifest entries (course code ->
+    cache key) and a list of (course code, error message)."""
+    semester, output, scales, shard, manifest = job
+    keys = OrderedDict()
+    errors = []
+    for course_name in shard:
+        key, error = call_job(plot_course, course_name, shard, output, scales,
+                              semester, manifest.get(course_name))
+        if error is not None:
+            errors.append((course_name, error))
+        elif key is not None:
+            keys[course_name] = key
+    return semester, keys, errors
+
+def shard_courses(course_names, courses, shards):
+    """Split courses round-robin into shards, each with its history slice."""
+    result = [OrderedDict() for i in range(shards)]
+    for i, course_name in enumerate(sorted(course_names)):
+        result[i % shards][course_name] = courses[course_name]
+    return [shard for shard in result if shard]
+
+def plot_dir(semester_name):
+    return "".join(["./data/", semester_name, "/outputs/plots/"])
+
+def plot_manifest_path(semester_name):
+    return cache_path("./data/"+semester_name, "plots")
+
+def plan_plots(courses, semester_name, shards=1, force=False):
+    """Jobs for plotting all courses of a semester, split into shards.
+
+    Only reads courses; each job gets the history of its own courses and
+    their entries from the manifest in outputs/.cache/plots.json.
+    """
+    manifest = OrderedDict()
+    if not force:
+        manifest = load_json_cache(plot_manifest_path(semester_name))
+    scales = load_compiled_scales("./data/"+semester_name+"/outputs/scales.json")
     semester = load_json("./data/"+semester_name+"/outputs/courses.json")
     courses_to_plot = list(semester.keys())
-    outdir = "".join(["./data/", semester_name, "/outputs/plots/"])
+    outdir = plot_dir(semester_name)
     if not os.path.exists(outdir):
         os.makedirs(outdir)
-    for c in courses_to_plot:
-        plot_course(c, courses, outdir, scales, semester_name)
-
-def plot_courses(semester):
-    semester = sys.argv[1]
-    courses = load_json("./data/courses.json")
-    scales = load_json("./data/"+semester+"/outputs/scales.json")
-    generate_plots(courses, scales, semester)
+    missing = [c for c in courses_to_plot if c not in courses]
+    for c in missing:
+        print("Warning: the course {} has no history, run courses.py first".format(c))
+    courses_to_plot = [c for c in courses_to_plot if c in courses]
+
+    shards = max(1, min(shards, len(courses_to_plot)))
+    jobs = []
+    for shard in shard_courses(courses_to_plot, courses, shards):
+        shard_manifest = {c: manifest[c] for c in shard if c in manifest}
+        jobs.append((semester_name, outdir, scales, shard, shard_manifest))
+    return jobs
+
+def run_plot_jobs(jobs, processes=1):
+    """Plot all jobs, on a process pool if processes > 1.
+
+    Every worker has its own matplotlib state; output paths only depend on
+    the semester and course code, so the result is the same for any number
+    of workers. Writes each semester's plot manifest and returns the number
+    of courses that could not be plotted.
+    """
+    results = run_jobs(plot_shard, jobs, processes)
+
+    manifests = OrderedDict()
+    for job in jobs:
+        manifests[job[0]] = OrderedDict()
+    errors = []
+    for job, (result, error) in zip(jobs, results):
+        if error is not None:
+            semester_name, output, scales, shard, manifest = job
+            errors.extend((semester_name, c, error) for c in shard)
+            continue
+        semester_name, keys, shard_errors = result
+        manifests[semester_name].update(keys)
+        errors.extend((semester_name, c, e) for c, e in shard_errors)
+    for semester_name, manifest in manifests.items():
+        manifest = OrderedDict(sorted(manifest.items()))
+        dump_json_if_changed(manifest, plot_manifest_path(semester_name))
+
+    for semester_name, course_name, error in sorted(errors):
+        print("Error: could not plot {} {}:".format(course_name, semester_name))
+        print(error)
+    return len(errors)
+
+def generate_plots(courses, semester_names, processes=1, force=False):
+    """Plot all courses of the given semesters in one run.
+
+    courses is the course history, loaded once and only read, so it can be
+    shared by all semesters. Semesters without outputs/courses.json or
+    scales.json are skipped with a warning, a semester that can't be planned
+    counts as one failure. Returns the number of failures.
+    """
+    jobs = []
+    failed = 0
+    for semester_name in semester_names:
+        outputs = "./data/"+semester_name+"/outputs/"
+        missing = [f for f in ("courses.json", "scales.json")
+                   if not os.path.exists(outputs+f)]
+        if missing:
+            print("Warning: skipping {}, it has no {}".format(
+                semester_name, " or ".join("outputs/"+f for f in missing)))
+            continue
+        semester_jobs, error = call_job(plan_plots, courses, semester_name,
+                                        processes, force)
+        if error is not None:
+            print("Error: could not plot {}:".format(semester_name))
+            print(error)
+            failed += 1
+            continue
+        jobs.extend(semester_jobs)
+    return failed + run_plot_jobs(jobs, processes)
+
+def plot_courses(semesters, processes=1, force=False):
+    courses = load_history("./data")
+    return generate_plots(courses, semesters, processes, force)
+
+def get_args():
+    argparser = argparse.ArgumentParser(
+                description = "Plot the general assessment history of each course")
+    argparser.add_argument("semester", help="Semester, e.g. V2017", type=str,
+                           nargs="?")
+    argparser.add_argument("--range", "-r", nargs=2, metavar=("FIRST", "LAST"),
+                           help="Backfill the plots of all semesters from FIRST"
+                           " to LAST, e.g. V2009 H2026")
+    argparser.add_argument("--jobs", "-j", default=os.cpu_count() or 1,
+                           help="Number of worker processes", type=int)
+    argparser.add_argument("--force", "-f", action="store_true",
+                           help="Render all plots, ignoring the plot cache")
+    args = argparser.parse_args()
+    if args.range:
+        args.semesters = semester_range(*args.range)
+    elif args.semester:
+        args.semesters = [args.semester]
+    else:
+        argparser.error("Specify a semester or --range")
+    return args
 
 if __name__ == "__main__":
-    plot_courses(sys.argv[1])
+    args = get_args()
+    if plot_courses(args.semesters, args.jobs, args.force):
+        sys.exit(1)
@@ -13,10 +13,20 @@ import sys
 import csv
 import json
 import argparse
+import hashlib
 from bs4 import BeautifulSoup
 from collections import OrderedDict
 
-from file_funcs import dump_json, load_json, path_join
+from courses import get_semesters
+from file_funcs import (load_json, path_join, path_clean,
+                        dump_json_if_changed, load_json_cache, cache_path,
+                        file_fingerprint, dump_columns, columns_path,
+                        scaled_responses, run_jobs)
+
+DEFAULT_SCALES_PATH = "./resources/scales.json"
+# Bump to reconvert all tsv files when the outputs change. 3: free text is
+# only kept in the column store.
+OUTPUTS_VERSION = 3
 
 def get_args():
     argparser = argparse.ArgumentParser(
@@ -24,39 +34,76 @@ def get_args():
     argparser.add_argument("--output", "-o", help="Output dir", type=str)
     argparser.add_argument("--input", "-i", help="Input dir/file", type=str)
     argparser.add_argument("--semester", "-s", default="all", help="Semester", type=str)
+    argparser.add_argument("--force", "-f", action="store_true",
+                           help="Reparse all tsv files, ignoring the manifest")
+    argparser.add_argument("--scales", help="scales.json used to tell scaled"
+                           " questions from free text (-i/-o mode)",
+                           default=DEFAULT_SCALES_PATH, type=str)
+    argparser.add_argument("--jobs", "-j", default=os.cpu_count() or 1,
+                           help="Number of worker processes", type=int)
 
     args = argparser.parse_args()
+    args.manifest = None
+    args.semesters = None
 
     if args.semester:
         if args.semester == "all":
-            dirs = next(os.walk('data'))[1]
-            for d in dirs:
-                if d.replace("/", "") == "all":
-                    sys.exit("Error: Recursion check failed - 'all' folder!")
-                if d[0] != ".":
-                    os.system("python3 fui_kk/responses.py -s "+d)
-            sys.exit()
+            args.semesters = get_semesters("data")
+            return args
         else:
-            args.input = path_join("data",args.semester,"downloads/tsv")
-            args.output = path_join("data",args.semester,"outputs/responses")
+            args.input, args.output, args.manifest = semester_paths(args.semester)
+            args.scales = semester_scales_path(args.semester)
 
     if not args.input or not args.output:
         sys.exit("Error: Specify input and output using -i and -o parameters, or semester using -s parameter")
     return args
 
+def semester_paths(semester):
+    semester_path = path_join("data", semester)
+    return (path_join(semester_path, "downloads/tsv"),
+            path_join(semester_path, "outputs/responses"),
+            cache_path(semester_path, "responses"))
+
+def semester_scales_path(semester):
+    """The semester's scales.json, or the default one before it exists."""
+    path = path_join("data", semester, "outputs/scales.json")
+    if os.path.exists(path):
+        return path
+    return DEFAULT_SCALES_PATH
+
+def get_scaled_questions(scales_path):
+    """Sorted list of the questions with a scale in scales.json."""
+    if not scales_path or not os.path.exists(scales_path):
+        return []
+    return sorted(load_json(scales_path).keys())
+
+def questions_digest(questions):
+    return hashlib.sha1("\n".join(questions).encode("utf-8")).hexdigest()
+
 def parse_course_tsv(tsv_filename):
-    data = []
-    with open(tsv_filename, encoding='utf-8') as tsv_file:
-        for row in csv.reader(tsv_file, delimiter='\t'):
-            data.append(row)
-    labels = data[0]
-    responses_raw = data[1:]
+    """Parse a tsv file into an OrderedDict of question -> list of answers.
+
+    Rows are streamed from the csv reader straight into the column lists, so
+    the raw rows are never held in memory alongside the result. Short rows
+    are padded with empty answers, extra fields are dropped and blank lines
+    are skipped.
+    """
     responses = OrderedDict()
-    for l in labels:
-        responses[l] = []
-    for r in range(0, len(responses_raw)):
-        for i in range(0,len(labels)):
-            responses[labels[i]].append(responses_raw[r][i])
+    with open(tsv_filename, encoding='utf-8') as tsv_file:
+        reader = csv.reader(tsv_file, delimiter='\t')
+        labels = next(reader, [])
+        for l in labels:
+            responses[l] = []
+        # Duplicate labels share a list, like they did when transposing:
+        columns = [responses[l].append for l in labels]
+        width = len(columns)
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < width:
+                row.extend([""] * (width - len(row)))
+            for append, answer in zip(columns, row):
+                append(answer)
     return responses
 
 def init_csv_reader():
@@ -71,10 +118,7 @@ def init_csv_reader():
             overflow = True
             csv_max = int(csv_max/16)
 
-def parse_tsv_files(input_path, output_dir):
-    if not os.path.exists(input_path):
-        sys.exit("Error: invalid input path '{}'".format(input_path))
-
+def find_tsv_files(input_path):
     input_files = []
     if os.path.isfile(input_path):
         input_files.append(input_path)
@@ -83,6 +127,37 @@ def parse_tsv_files(input_path, output_dir):
             for file_x in files:
                 if file_x.endswith(".tsv"):
                     input_files.append(path_join(root,file_x))
+    return sorted(input_files)
+
+def output_path_for(tsv_filename, input_path, output_dir):
+    coursename = tsv_filename.replace(".tsv","")
+    coursename = coursename.replace(input_path, "")
+    coursename = coursename.replace("/", "")
+    return path_clean(path_join(output_dir,coursename)+".json")
+
+def up_to_date(entry, fingerprint):
+    return (entry is not None and
+            entry.get("version") == fingerprint["version"] and
+            entry.get("sha1") == fingerprint["sha1"] and
+            entry.get("output") == fingerprint["output"] and
+            entry.get("columns") == fingerprint["columns"] and
+            entry.get("scaled") == fingerprint["scaled"] and
+            os.path.exists(fingerprint["output"]) and
+            os.path.exists(fingerprint["columns"]))
+
+def plan_tsv_files(input_path, output_dir, manifest_path=None, force=False,
+                   scaled_questions=()):
+    """Find the tsv files that need converting.
+
+    Returns a list of (tsv path, output paths, scaled questions) jobs and the
+    new manifest (tsv path -> size, mtime, sha1, outputs and a digest of the
+    scaled questions). Files that are unchanged since the last
+    run, according to the old manifest, get no job.
+    """
+    if not os.path.exists(input_path):
+        sys.exit("Error: invalid input path '{}'".format(input_path))
+
+    input_files = find_tsv_files(input_path)
 
     if os.path.exists(output_dir):
         if os.path.isfile(output_dir):
@@ -90,17 +165,100 @@ def parse_tsv_files(input_path, output_dir):
     else:
         os.makedirs(output_dir)
 
+    manifest = OrderedDict()
+    if manifest_path and not force:
+        manifest = load_json_cache(manifest_path)
+    new_manifest = OrderedDict()
+    jobs = []
+    scaled_questions = frozenset(scaled_questions)
+    digest = questions_digest(sorted(scaled_questions))
+
     for tsv_filename in input_files:
-        coursename = tsv_filename.replace(".tsv","")
-        coursename = coursename.replace(input_path, "")
-        coursename = coursename.replace("/", "")
-        content = parse_course_tsv(tsv_filename)
-        dump_json(content, path_join(output_dir,coursename)+".json")
+        output_path = output_path_for(tsv_filename, input_path, output_dir)
+        entry = manifest.get(tsv_filename)
+        fingerprint = file_fingerprint(tsv_filename, entry)
+        fingerprint["output"] = output_path
+        fingerprint["columns"] = path_clean(columns_path(output_path))
+        fingerprint["scaled"] = digest
+        fingerprint["version"] = OUTPUTS_VERSION
+        if not up_to_date(entry, fingerprint):
+            outputs = (output_path, fingerprint["columns"])
+            jobs.append((tsv_filename, outputs, scaled_questions))
+        new_manifest[tsv_filename] = fingerprint
+    return jobs, new_manifest
+
+def convert_tsv(job):
+    """Worker function, writes the responses json and column store."""
+    tsv_filename, outputs, scaled_questions = job
+    output_path, output_columns = outputs
+    content = parse_course_tsv(tsv_filename)
+    dump_json_if_changed(scaled_responses(content, scaled_questions), output_path)
+    dump_columns(content, scaled_questions, output_columns)
+
+def convert_jobs(jobs, processes):
+    """Convert all jobs, in a process pool if there is more than one.
+
+    Returns an OrderedDict of tsv path -> error message for failed jobs.
+    """
+    results = run_jobs(convert_tsv, jobs, processes, initializer=init_csv_reader)
+    errors = OrderedDict()
+    for (tsv_filename, outputs, scaled_questions), (result, error) in zip(jobs, results):
+        if error is not None:
+            errors[tsv_filename] = error
+    return errors
+
+def finish_manifest(manifest, manifest_path, errors):
+    if not manifest_path:
+        return
+    # Failed files are left out so they are retried on the next run:
+    for tsv_filename in errors:
+        manifest.pop(tsv_filename, None)
+    dump_json_if_changed(manifest, manifest_path)
+
+def report_errors(errors):
+    if not errors:
+        return
+    for tsv_filename, error in errors.items():
+        print("Error: could not convert '{}':".format(tsv_filename))
+        print(error)
+    sys.exit("Error: {} tsv file(s) failed to convert".format(len(errors)))
+
+def parse_tsv_files(input_path, output_dir, manifest_path=None, force=False,
+                    processes=1, scales_path=DEFAULT_SCALES_PATH):
+    jobs, manifest = plan_tsv_files(input_path, output_dir, manifest_path, force,
+                                    get_scaled_questions(scales_path))
+    errors = convert_jobs(jobs, processes)
+    finish_manifest(manifest, manifest_path, errors)
+    report_errors(errors)
+
+def parse_semesters(semesters, force=False, processes=1):
+    """Convert the tsv files of several semesters using one shared pool."""
+    plans = []
+    jobs = []
+    for semester in semesters:
+        input_path, output_dir, manifest_path = semester_paths(semester)
+        if not os.path.isdir(input_path):
+            print("Warning: skipping {}, '{}' doesn't exist".format(semester, input_path))
+            continue
+        scaled_questions = get_scaled_questions(semester_scales_path(semester))
+        semester_jobs, manifest = plan_tsv_files(input_path, output_dir,
+                                                 manifest_path, force,
+                                                 scaled_questions)
+        plans.append((manifest, manifest_path))
+        jobs.extend(semester_jobs)
+    errors = convert_jobs(jobs, processes)
+    for manifest, manifest_path in plans:
+        finish_manifest(manifest, manifest_path, errors)
+    report_errors(errors)
 
 def main():
     args = get_args()
     init_csv_reader()
-    parse_tsv_files(args.input, args.output)
+    if args.semesters is not None:
+        parse_semesters(args.semesters, args.force, args.jobs)
+    else:
+        parse_tsv_files(args.input, args.output, args.manifest, args.force,
+                        args.jobs, args.scales)
 
 if __name__ == "__main__":
     main()
@@ -12,10 +12,14 @@ __license__    = "MIT"
 import os
 import sys
 import json
+import argparse
 from bs4 import BeautifulSoup
 from collections import OrderedDict
 
-from file_funcs import dump_json, load_json, path_join
+from courses import get_semesters
+from file_funcs import (dump_json, load_json, path_join, load_fresh_columns,
+                        dump_json_if_changed, load_json_cache, cache_path,
+                        file_fingerprint, run_jobs)
 
 def answer_case(answer_raw):
     answer = answer_raw.upper()
@@ -32,8 +36,82 @@ def convert_answer_case(scales):
                 scales[question][answer_list] = \
                 [answer_case(x) for x in scales[question][answer_list]]
 
-def scales_add_course(response_file_path, scales):
-    course = load_json(response_file_path)
+def course_vocabulary(response_file_path, questions=()):
+    """question -> distinct answers (first seen first) of a course.
+
+    Reads the scaled questions, plus the free text columns in the column
+    store whose question is in questions (questions added to scales.json
+    since the responses were parsed). Other free text is never decoded.
+    """
+    store = load_fresh_columns(response_file_path)
+    vocabulary = OrderedDict()
+    if store is None:
+        for question, answers in load_json(response_file_path).items():
+            vocabulary[question] = list(OrderedDict.fromkeys(answers))
+        return vocabulary
+    with store:
+        for question in store:
+            if store.is_scaled(question) or question in questions:
+                vocabulary[question] = store.vocabulary(question)
+        return vocabulary
+
+# Bump to rescan all courses when course_vocabulary changes. 2: only
+# scaled questions.
+VOCABULARY_VERSION = 2
+
+def semester_vocabularies(semester_path, questions=()):
+    """Vocabularies of all courses in a semester, by responses filename.
+
+    The vocabularies of the scaled questions are cached in
+    outputs/.cache/vocabulary.json with the fingerprint of the responses
+    file they came from, only new or changed files are scanned again.
+    Questions in questions that were free text when the responses were
+    parsed are read from the column stores on every call, without caching.
+    """
+    responses_path = path_join(semester_path, "outputs/responses")
+    cache_file = cache_path(semester_path, "vocabulary")
+    cache = load_json_cache(cache_file)
+    new_cache = OrderedDict()
+    filenames = []
+    for (dirpath, dirnames, files) in os.walk(responses_path):
+        filenames = sorted(f for f in files if f.endswith(".json"))
+        break
+    for filename in filenames:
+        file_path = path_join(responses_path, filename)
+        entry = cache.get(filename)
+        fingerprint = file_fingerprint(file_path, entry)
+        fingerprint["version"] = VOCABULARY_VERSION
+        if entry and entry.get("sha1") == fingerprint["sha1"] and \
+                entry.get("version") == VOCABULARY_VERSION and "vocabulary" in entry:
+            fingerprint["vocabulary"] = entry["vocabulary"]
+        else:
+            fingerprint["vocabulary"] = course_vocabulary(file_path)
+        new_cache[filename] = fingerprint
+    dump_json_if_changed(new_cache, cache_file)
+    vocabularies = OrderedDict()
+    for filename, entry in new_cache.items():
+        vocabulary = entry["vocabulary"]
+        unscaled = [q for q in questions if q not in vocabulary]
+        if unscaled:
+            file_path = path_join(responses_path, filename)
+            vocabulary = OrderedDict(vocabulary)
+            vocabulary.update(course_vocabulary(file_path, unscaled))
+        vocabularies[filename] = vocabulary
+    return vocabularies
+
+def scales_add_course(response_file_path, scales, seen=None):
+    scales_add_vocabulary(course_vocabulary(response_file_path), scales, seen)
+
+def scales_add_vocabulary(course, scales, seen=None):
+    """Add new answers of a course (question -> answers) to the "all" lists
+    in scales.
+
+    seen maps questions to the set of answers already in "all", pass the
+    same dict for every course of a semester so membership tests stay
+    constant time. Answers are appended in the order they are first seen.
+    """
+    if seen is None:
+        seen = {}
     for question, answers in course.items():
         if question in scales:
             if "order" not in scales[question]:
@@ -42,9 +120,13 @@ def scales_add_course(response_file_path, scales):
                 scales[question]["all"] = []
             if "ignore" not in scales[question]:
                 scales[question]["ignore"] = []
+            known = seen.get(question)
+            if known is None:
+                known = seen[question] = set(scales[question]["all"])
             for answer in answers:
                 answer_cap = answer_case(answer)
-                if answer_cap not in scales[question]["all"]:
+                if answer_cap not in known:
+                    known.add(answer_cap)
                     scales[question]["all"].append(answer_cap)
                     print('Warning: Adding "{}" to "{}", you will probably have to update scales.json'.format(answer_cap, question))
 
@@ -73,13 +155,15 @@ def get_all_default_answers():
 
 def default_sort(old_order):
     default_order = get_default_order()
+    default_set = set(default_order)
+    old_set = set(old_order)
 
     new_order = []
     for answer in old_order:
-        if answer not in default_order:
+        if answer not in default_set:
             new_order.append(answer)
     for answer in default_order:
-        if answer in old_order:
+        if answer in old_set:
             new_order.append(answer)
     assert len(new_order) == len(old_order)
     return new_order
@@ -92,7 +176,7 @@ def default_sort_scales(scales):
 def autofill_question(answer_lists):
     answer_lists["order"] = []
     answer_lists["ignore"] = []
-    default_ignore = get_default_ignore()
+    default_ignore = set(get_default_ignore())
     for answer in answer_lists["all"]:
         if answer in default_ignore:
             answer_lists["ignore"].append(answer)
@@ -123,7 +207,13 @@ def autofill_prompt(scales):
         print("Please open scales.json to correct this question before running this script again")
         raise AutofillException("Incorrect autofill raised by user")
 
-def autofill_scales(scales):
+def autofill_scales(scales, review=None):
+    """Autofill questions whose answers are all known defaults.
+
+    Every autofilled question is shown and has to be confirmed by the user,
+    unless a review list is given (batch mode); then a record of each
+    autofill is appended to it instead, for reviewing afterwards.
+    """
     default_answers = set(get_all_default_answers())
     for question, answer_lists in scales.items():
         if (not question) or ("all" not in answer_lists):
@@ -136,7 +226,18 @@ def autofill_scales(scales):
         num_ignore  = len(list_ignore)
         if num_all != num_order + num_ignore:
             if set(list_all).issubset(default_answers):
+                before = OrderedDict()
+                before["order"] = list(list_order)
+                before["ignore"] = list(list_ignore)
                 autofill_question(scales[question])
+                if review is not None:
+                    record = OrderedDict()
+                    record["question"] = question
+                    record["decision"] = "autofilled"
+                    record["before"] = before
+                    record["after"] = scales[question]
+                    review.append(record)
+                    continue
                 print("")
                 print("Warning: The question below has been autofilled and should be reviewed:")
                 print("Make sure that the structure below is correct (see README.md).")
@@ -182,19 +283,24 @@ def error_check(scales):
         if num_all != (num_order + num_ignore):
             add_error(errors, question, "all != order + ignore,"
             " you should copy the answers from all into order/ignore.")
+        set_all    = set(list_all)
+        set_order  = set(list_order)
+        set_ignore = set(list_ignore)
+        in_both    = set_order & set_ignore
+        in_neither = set_all - set_order - set_ignore
         for answer in list_all:
-            if answer in list_order and answer in list_ignore:
+            if answer in in_both:
                 add_error(errors, question,
                 '"{}" cannot be in both order and ignore.'.format(answer))
-            elif answer not in list_order and answer not in list_ignore:
+            elif answer in in_neither:
                 add_error(errors, question,
                 '"{}" must be in either order or ignore.'.format(answer))
         for answer in list_order:
-            if answer not in list_all:
+            if answer not in set_all:
                 add_error(errors, question,
                 '"{}" is in order but not in all, typo?'.format(answer))
         for answer in list_ignore:
-            if answer not in list_all:
+            if answer not in set_all:
                 add_error(errors, question,
                 '"{}" is in ignore but not in all, typo?'.format(answer))
     return errors
@@ -220,7 +326,16 @@ def print_error_check(scales):
     print("")
     return True
 
-def generate_scales(semester):
+def review_path(semester):
+    return "./data/"+semester+"/outputs/scales_review.json"
+
+def generate_scales(semester, batch=False):
+    """Update the scales.json of a semester with the answers of its courses.
+
+    In batch mode nothing is asked, autofills and errors are written to
+    outputs/scales_review.json instead. Returns the review (None when not
+    in batch mode).
+    """
     scales = OrderedDict()
     scales_path = "./data/"+semester+"/outputs/scales.json"
     default_scales_path = "./resources/scales.json"
@@ -236,15 +351,21 @@ def generate_scales(semester):
 
     convert_answer_case(scales)
 
-    responses_path = "./data/"+semester+"/outputs/responses/"
-    for (dirpath, dirnames, filenames) in os.walk(responses_path):
-        for filename in filenames:
-            if filename.endswith(".json"):
-                file_path = path_join(dirpath,filename)
-                scales_add_course(file_path, scales)
-        break
+    seen = {}
+    for vocabulary in semester_vocabularies("./data/"+semester, list(scales)).values():
+        scales_add_vocabulary(vocabulary, scales, seen)
 
     default_sort_scales(scales)
+    if batch:
+        review = OrderedDict()
+        review["semester"] = semester
+        review["scales"] = scales_path
+        review["autofilled"] = []
+        autofill_scales(scales, review["autofilled"])
+        dump_json(scales, scales_path)
+        review["errors"] = error_check(scales)
+        dump_json_if_changed(review, review_path(semester))
+        return review
     try:
         autofill_scales(scales)
     except AutofillException:
@@ -255,18 +376,64 @@ def generate_scales(semester):
         print("You will have to edit the file manually to add/edit/remove questions.")
         sys.exit(1)
 
+def generate_scales_job(semester):
+    """Worker function for batch mode, returns the review of the semester."""
+    return generate_scales(semester, batch=True)
+
 def all_semesters():
-    for (dirpath, dirnames, filenames) in os.walk("./data"):
-        for semester in dirnames:
-            if semester[0] != ".":
-                generate_scales(semester)
-        break
+    for semester in get_semesters("./data"):
+        generate_scales(semester)
 
-if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print("Usage: python3 ./fui_kk/scales.py SEMESTER")
-        sys.exit(1)
-    if sys.argv[1] == "all":
+def batch_semesters(semesters, processes=1):
+    """Generate scales for semesters without asking anything, in a process
+    pool. Prints a summary and returns the number of semesters that need
+    attention (errors in scales.json or failures)."""
+    results = run_jobs(generate_scales_job, semesters, processes)
+
+    failed = 0
+    print("")
+    print("SCALES SUMMARY")
+    for semester, (review, error) in zip(semesters, results):
+        if error is not None:
+            failed += 1
+            print("{}: failed:".format(semester))
+            print(error)
+            continue
+        autofilled = len(review["autofilled"])
+        errors = sum(len(messages) for messages in review["errors"].values())
+        if errors:
+            failed += 1
+        if autofilled or errors:
+            print("{}: {} autofilled question(s) to review, {} error(s), see {}".format(
+                semester, autofilled, errors, review_path(semester)))
+        else:
+            print("{}: ok".format(semester))
+    print("END OF SCALES SUMMARY")
+    return failed
+
+def get_args():
+    argparser = argparse.ArgumentParser(
+                description = "Update scales.json of semester(s) with all answers")
+    argparser.add_argument("semester", help="Semester, or 'all'", type=str)
+    argparser.add_argument("--batch", "-b", action="store_true",
+                           help="Don't ask, record autofills and errors in"
+                           " outputs/scales_review.json")
+    argparser.add_argument("--jobs", "-j", default=os.cpu_count() or 1,
+                           help="Number of worker processes (batch mode)", type=int)
+    return argparser.parse_args()
+
+def main():
+    args = get_args()
+    semesters = [args.semester]
+    if args.semester == "all":
+        semesters = get_semesters("./data")
+    if args.batch:
+        if batch_semesters(semesters, args.jobs):
+            sys.exit(1)
+    elif args.semester == "all":
         all_semesters()
     else:
-        generate_scales(sys.argv[1])
+        generate_scales(args.semester)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-"""Calculate the average score for a semester"""
+"""Calculate the average score for semesters"""
 
 __authors__    = ["Ole Herman Schumacher Elgesem"]
 __license__    = "MIT"
@@ -13,23 +13,95 @@ import argparse
 from collections import OrderedDict
 import numpy
 
-def find_all(dictionary, search_key):
-    hits = []
-    for key,value in dictionary.items():
-        if type(value) is dict:
-            hits.extend(find_all(value, search_key))
-        elif key == search_key:
-            hits.append(dictionary[key])
-    return hits
-
-def calculate_average(semester):
-    with open("./data/"+semester+"/outputs/courses.json", "r") as f:
-        courses = json.load(f)
-    averages = find_all(courses, "average")
-    average = numpy.mean(averages)
-    average = round(average, 2)
-    return average
+from file_funcs import load_json, write_if_changed
+from courses import get_semester_order, load_history
+
+GENERAL_QUESTIONS = ["Hva er ditt generelle intrykk av kurset?",
+                     "Hva er ditt generelle inntrykk av kurset?",
+                     "How do you rate the course in general?",
+                     "What is your general impression of the course?"]
+
+def general_average(semester_data):
+    """(average, respondents) of the general question, None if missing."""
+    for question in GENERAL_QUESTIONS:
+        if question in semester_data:
+            average = semester_data[question]["average"]
+            if average == "None":
+                return None
+            return average, int(semester_data["respondents"]["answered"])
+    return None
+
+def semester_averages(courses, weighted=False):
+    """Average general score of every semester in the course history
+    (course code -> semester -> course data, or a CourseHistory), in
+    semester order.
+
+    With weighted=True each course counts by its number of respondents.
+    The history is flattened into arrays once and all semesters are
+    averaged together with bincount.
+    """
+    semester_index = OrderedDict()
+    indices = []
+    averages = []
+    weights = []
+    for course in courses.values():
+        for semester, semester_data in course.items():
+            found = general_average(semester_data)
+            if found is None:
+                continue
+            if semester not in semester_index:
+                semester_index[semester] = len(semester_index)
+            indices.append(semester_index[semester])
+            averages.append(found[0])
+            weights.append(found[1] if weighted else 1)
+    if not indices:
+        return OrderedDict()
+    indices = numpy.array(indices, dtype=numpy.intp)
+    averages = numpy.array(averages, dtype=numpy.float64)
+    weights = numpy.array(weights, dtype=numpy.float64)
+    totals = numpy.bincount(indices, weights=averages * weights)
+    counts = numpy.bincount(indices, weights=weights)
+
+    order = get_semester_order(2000, 2030)
+    def sort_key(semester):
+        return order.index(semester) if semester in order else len(order)
+    result = OrderedDict()
+    for semester in sorted(semester_index, key=sort_key):
+        i = semester_index[semester]
+        if counts[i] > 0:
+            result[semester] = round(float(totals[i] / counts[i]), 2)
+    return result
+
+def score_js(averages):
+    """JavaScript defining fui_avg_score for vurdering.js, which uses the
+    1-based scale (average + 1)."""
+    scores = OrderedDict((s, round(a + 1, 2)) for s, a in averages.items())
+    return "// Generated by fui_kk/score.py, do not edit.\nvar fui_avg_score = {};\n".format(
+        json.dumps(scores, indent=2))
+
+def get_args():
+    argparser = argparse.ArgumentParser(
+                description = "Calculate average scores from the course history")
+    argparser.add_argument("semester", nargs="?", help="Print the average of this semester", type=str)
+    argparser.add_argument("--weighted", "-w", action="store_true",
+                           help="Weight courses by number of respondents")
+    argparser.add_argument("--js", help="Write all semester averages to this"
+                           " file, for vurdering.js", type=str)
+    argparser.add_argument("--courses", help="Course history json"
+                           " (default: the history in ./data)", type=str)
+    return argparser.parse_args()
 
 if __name__ == '__main__':
-    a = calculate_average(sys.argv[1])
-    print("Semester average for {} is {}( or {} in scale used by vurdering.js)".format(sys.argv[1], a, a+1))
+    args = get_args()
+    if args.courses:
+        courses = load_json(args.courses)
+    else:
+        courses = load_history("./data")
+    averages = semester_averages(courses, args.weighted)
+    if args.js:
+        write_if_changed(score_js(averages), args.js)
+    if args.semester:
+        if args.semester not in averages:
+            sys.exit("No scores for {}".format(args.semester))
+        a = averages[args.semester]
+        print("Semester average for {} is {}( or {} in scale used by vurdering.js)".format(args.semester, a, round(a+1, 2)))
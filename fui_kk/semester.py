@@ -15,7 +15,12 @@ import json
 from file_funcs import dump_json, load_json
 
 def get_course_data(path):
-    course = load_json(path)
+    return course_data_from_stats(load_json(path), path)
+
+def course_data_from_stats(stats, path=None):
+    """The semester summary of a course: its stats with only the general
+    question kept (moved to the top level). stats is not modified."""
+    course = OrderedDict(stats)
     language = course["language"]
 
     if language == "NO":
@@ -40,7 +45,7 @@ def get_course_data(path):
 
 def main(semester_dir):
     files = []
-    for f in os.listdir(semester_dir+"/outputs/stats"):
+    for f in sorted(os.listdir(semester_dir+"/outputs/stats")):
         if f.endswith(".json"):
             files.append(f)
     semester_data = OrderedDict()
@@ -52,7 +57,7 @@ def main(semester_dir):
 if __name__ == '__main__':
     semesters = []
     for root, subdirs, files in os.walk("./data"):
-        semesters = filter(lambda x: ".git" not in x, subdirs)
+        semesters = filter(lambda x: not x.startswith("."), subdirs)
         break
     for sem in semesters:
         main("./data/"+sem)
@@ -12,8 +12,69 @@ import os
 import sys
 import json
 import re
+import argparse
+import hashlib
 from collections import OrderedDict
-from file_funcs import dump_json, load_json, path_join
+from file_funcs import (dump_json, load_json, path_join, json_text,
+                        write_if_changed, dump_json_if_changed,
+                        load_json_cache, cache_path, file_fingerprint,
+                        optional_fingerprint, run_jobs)
+from compiled_scales import load_compiled_scales
+from courses import load_history, get_semesters, semester_range
+
+TEMPLATE_DIR = "./resources/web"
+TEMPLATE_FILES = OrderedDict([("NO", "course-no.html"),
+                              ("EN", "course-en.html"),
+                              ("index", "semester-index.html"),
+                              ("index-eng", "semester-index-eng.html")])
+
+# Bump to invalidate the web build manifests when the page layout changes:
+WEB_VERSION = 2
+
+def sha1_text(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class Template:
+    """A html template, split once into literal text and $TAG placeholders.
+
+    render() fills in all placeholders with a single join. The values are
+    never scanned for tags, so a $TAG inside a summary is left as it is.
+    Tags without a value are kept.
+    """
+    tag_pattern = re.compile(r"(\$[A-Z_]+)")
+
+    def __init__(self, text):
+        self.digest = sha1_text(text)
+        # Literals at even indices, tags at odd:
+        self.parts = self.tag_pattern.split(text)
+        self.tag_indices = range(1, len(self.parts), 2)
+
+    def render(self, values):
+        parts = list(self.parts)
+        for i in self.tag_indices:
+            parts[i] = values.get(parts[i], parts[i])
+        return "".join(parts)
+
+# Per process, template dir -> name -> Template:
+_templates = {}
+
+def load_templates(template_dir=TEMPLATE_DIR):
+    """The course and index templates, read and split once per process."""
+    if template_dir not in _templates:
+        templates = {}
+        for name, filename in TEMPLATE_FILES.items():
+            with open(path_join(template_dir, filename), 'r') as f:
+                templates[name] = Template(f.read())
+        _templates[template_dir] = templates
+    return _templates[template_dir]
+
+QUESTION_TEMPLATE = Template('''
+            <div id="$QUESTION_ID" class="question">
+                <h4>$QUESTION_LABEL: $QUESTION</h4>
+                <p>$AVERAGE_LABEL: $AVERAGE</p>
+                <div id="$CHART_ID" class="d3kk-chart"></div>
+            </div>
+        ''')
 
 def generate_semesters(start, stop):
     yield start
@@ -60,29 +121,31 @@ def get_participation_string(participation, language):
         labels = labels,
         percentage = 0 if invited == 0 else (answered / invited * 100))
 
-def create_chart_js(question, question_stats, scales, chart_id):
-    chart_data = []
-    answers = scales[question]["order"]
-    for answer in answers:
-        if answer in question_stats["counts"]:
-            count = question_stats["counts"][answer]
-        else:
-            count = 0
-        chart_data.append('{{ label: "{}", value: {} }}'.format(answer, count))
-
-    if len(answers) == 9:
-        colors = "['#21428c', '#4573b8', '#7c81be', '#a8bfd5', '#c2b59b', '#e2dda6', '#aad58f', '#f7a21c', '#bf2026']"
-    elif len(answers) == 7:
-        colors = "['#21428c', '#4573b8', '#a8bfd5', '#c2b59b', '#e2dda6', '#f7a21c', '#bf2026']"
-    elif len(answers) == 6:
-        colors = "['#21428c', '#4573b8', '#a8bfd5', '#c2b59b', '#f7a21c', '#bf2026']"
-    elif len(answers) == 5:
-        colors = "['#21428c', '#4573b8', '#c2b59b', '#f7a21c', '#bf2026']"
-    else:
-        print("Warning: Chart for '{}' omitted. No colors defined for questions with {} alternatives".format(
-            question, len(answers)))
-        return ''
-    return 'insert_chart("#{}", [{}], {});'.format(chart_id, ", ".join(chart_data), colors)
+def chart_payload(questions, scales, chart_ids):
+    """Answer counts for the charts of a course page as compact json.
+
+    Questions sharing a scale share one entry of answers and colors in
+    "scales", each chart is [chart id, scale index, counts]. The payload is
+    drawn by render_chart() in resources/web/copy/course.js.
+    """
+    payload = OrderedDict([("scales", []), ("charts", [])])
+    scale_index = {}
+    for question, question_stats in questions.items():
+        scale = scales[question]
+        answers = scale.order
+        if scale.colors is None:
+            print("Warning: Chart for '{}' omitted. No colors defined for questions with {} alternatives".format(
+                question, len(answers)))
+            continue
+        key = (tuple(answers), tuple(scale.colors))
+        if key not in scale_index:
+            scale_index[key] = len(payload["scales"])
+            payload["scales"].append([list(answers), list(scale.colors)])
+        counts = [question_stats["counts"].get(answer, 0) for answer in answers]
+        payload["charts"].append([chart_ids[question], scale_index[key], counts])
+    text = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    # Can't end the <script> element it is embedded in:
+    return text.replace("</", "<\\/")
 
 def web_report_course(summary_path, stat_path, output_path, html_templates, courses, scales, current_semester):
     stats = load_json(stat_path)
@@ -118,7 +181,6 @@ def web_report_course(summary_path, stat_path, output_path, html_templates, cour
     course_url = "https://www.uio.no/studier/emner/matnat/ifi/"+course_code
 
     main_contents = []
-    additional_js = []
     if language == "NO":
         main_contents.append(r"<h2>Vurdering:</h2>")
         main_contents.append(r"Velg spørsmål for å se data fra studentenes vurdering:<br />")
@@ -128,24 +190,19 @@ def web_report_course(summary_path, stat_path, output_path, html_templates, cour
 
     options = []
     questions = []
+    chart_ids = {}
     for question, question_stats in stats["questions"].items():
         question_id = re.sub('[^a-z]+', '', question.lower())
         chart_id = 'chart_' + question_id
-        questions.append('''
-            <div id="{question_id}" class="question">
-                <h4>{question_label}: {question}</h4>
-                <p>{average_label}: {average}</p>
-                <div id="{chart_id}" class="d3kk-chart"></div>
-            </div>
-        '''.format(
-            question_id=question_id,
-            question_label='Spørsmål' if language == "NO" else 'Question',
-            question=question,
-            average_label='Gjennsomsnittlig svar' if language == "NO" else 'Average answer',
-            average=question_stats["average_text"],
-            chart_id=chart_id
-        ))
-        additional_js.append(create_chart_js(question, question_stats, scales, chart_id))
+        questions.append(QUESTION_TEMPLATE.render({
+            "$QUESTION_ID": question_id,
+            "$QUESTION_LABEL": 'Spørsmål' if language == "NO" else 'Question',
+            "$QUESTION": question,
+            "$AVERAGE_LABEL": 'Gjennsomsnittlig svar' if language == "NO" else 'Average answer',
+            "$AVERAGE": question_stats["average_text"],
+            "$CHART_ID": chart_id
+        }))
+        chart_ids[question] = chart_id
         options.append('<option value="{}">{}</option>'.format(question_id, question))
 
     main_contents.append('<select id="select_question" onchange="show_selected_question();">')
@@ -160,36 +217,6 @@ def web_report_course(summary_path, stat_path, output_path, html_templates, cour
     ))
     main_contents.extend(questions)
 
-    additional_js.append('''
-        function show_selected_question() {
-            var choice = document.getElementById("select_question").value;
-            var questions = document.querySelectorAll('.question');
-            for (var i = 0; i < questions.length; i++) {
-                questions[i].hidden = true;
-            }
-            document.querySelector('#' + choice).hidden = false;
-
-            document.querySelector('#button_show_all_questions').style.display = 'inline';
-            document.querySelector('#button_hide_all_questions').style.display = 'none';
-        }
-
-        function show_all_questions() {
-            if (!document.querySelector('.question[hidden]')) {
-                show_selected_question();
-                return;
-            }
-            var questions = document.querySelectorAll('.question');
-            for (var i = 0; i < questions.length; i++) {
-                questions[i].hidden = false;
-            }
-
-            document.querySelector('#button_show_all_questions').style.display = 'none';
-            document.querySelector('#button_hide_all_questions').style.display = 'inline';
-        }
-
-        show_selected_question();
-    ''')
-
     if language == "NO":
         main_contents.append(r"<h2>Oppsummering:</h2>")
     else:
@@ -211,7 +238,7 @@ def web_report_course(summary_path, stat_path, output_path, html_templates, cour
     main_body = "\n".join(main_contents)
 
     course_rating = []
-    course_dict = courses[course_code]
+    course_dict = OrderedDict(courses[course_code])
     if int(current_semester[1:]) >= 2017:
         for sem in generate_semesters("V2000", "H2016"):
             if sem in course_dict:
@@ -231,47 +258,65 @@ def web_report_course(summary_path, stat_path, output_path, html_templates, cour
         "$SEMESTER": semester,
         "$GENERAL_AVERAGE_TEXT": general_average_text,
         "$MAIN_BODY": main_body,
-        "$ADDITIONAL_JS": "\n".join(additional_js),
+        "$CHART_DATA": chart_payload(stats["questions"], scales, chart_ids),
         "$COURSE_URL": course_url,
         "$COURSE_RATING": str(course_rating).replace("'", '"')
     }
-    html = html_templates[language]
-    for tag, replacement in replace_tags.items():
-        html = html.replace(tag, replacement)
+    html = html_templates[language].render(replace_tags)
 
-    with open(output_path,'w') as f:
-        f.write(html)
+    write_if_changed(html, output_path)
     return True
 
-def web_reports_semester_folder(semester_path):
+# Per worker, the read-only inputs shared by all courses (see init_worker):
+_shared = {}
+
+def init_worker(html_templates, courses, scales):
+    """Hand the templates, course history and scales (semester -> compiled
+    scales) to a worker once, instead of with every course."""
+    _shared["html_templates"] = html_templates
+    _shared["courses"] = courses
+    _shared["scales"] = scales
+
+def web_report_job(job):
+    """Worker function for one course page, returns whether it was
+    published."""
+    semester, course_code, summary_path, stat_path, output_path = job
+    return web_report_course(summary_path, stat_path, output_path,
+                             _shared["html_templates"], _shared["courses"],
+                             _shared["scales"][semester], semester)
+
+def run_web_report_jobs(jobs, html_templates, courses_all, scales, processes=1):
+    """Render the course pages of jobs, on a worker pool if processes > 1.
+
+    Returns (published, error message or None) in the order of jobs.
+    """
+    chunksize = max(1, len(jobs) // (max(1, processes) * 4))
+    return run_jobs(web_report_job, jobs, processes, initializer=init_worker,
+                    initargs=(html_templates, courses_all, scales),
+                    chunksize=chunksize)
+
+def web_report_jobs(semester_path, courses):
     semester = os.path.basename(semester_path)
-    courses = load_json(semester_path+"/outputs/courses.json")
-    scales = load_json(semester_path+"/outputs/scales.json")
     stats_path = semester_path+"/outputs/stats/"
     summaries_path = semester_path+"/outputs/web/converted"
     upload_path = semester_path+"/outputs/web/upload/"+semester
-
-    html_templates = {}
-    with open("./resources/web/course-no.html",'r') as f:
-        html_templates["NO"] = f.read()
-    with open("./resources/web/course-en.html",'r') as f:
-        html_templates["EN"] = f.read()
-    with open("./resources/web/semester-index.html",'r') as f:
-        html_templates["index"] = f.read()
-    with open("./resources/web/semester-index-eng.html",'r') as f:
-        html_templates["index-eng"] = f.read()
-    with open("./data/courses.json",'r') as f:
-        courses_all = json.load(f, object_pairs_hook=OrderedDict)
-
-    links = []
-    links.append('<ul class="fui_courses">')
+    jobs = []
     for course_code in courses:
         summary_path = path_join(summaries_path, course_code+".html")
         stat_path = path_join(stats_path, course_code+".json")
         output_path = path_join(upload_path, course_code+".html")
+        jobs.append((semester, course_code, summary_path, stat_path, output_path))
+    return jobs
+
+def web_report_index(semester_path, courses, published, html_templates):
+    """Write index.html and index-eng.html linking to the published courses."""
+    semester = os.path.basename(semester_path)
+    upload_path = semester_path+"/outputs/web/upload/"+semester
 
-        res = web_report_course(summary_path, stat_path, output_path, html_templates, courses_all, scales, semester)
-        if res:
+    links = []
+    links.append('<ul class="fui_courses">')
+    for course_code in courses:
+        if course_code in published:
             course_name = courses[course_code]["course"]["name"]
             links.append('<li><a href="'+course_code+'.html">' + course_code + ' - ' + course_name + '</a></li>')
     links.append("</ul>")
@@ -291,15 +336,169 @@ def web_reports_semester_folder(semester_path):
 
     links_str_no   = "<h2>{}</h2>".format(title["NO"]) + links_str
     links_str_en   = "<h2>{}</h2>".format(title["EN"]) + links_str
-    index_html     = html_templates["index"].replace("$COURSE_INDEX", links_str_no)
-    index_eng_html = html_templates["index-eng"].replace("$COURSE_INDEX", links_str_en)
-    index_html     = index_html.replace("$SEMESTER", semester)
-    index_eng_html = index_eng_html.replace("$SEMESTER", semester)
+    index_html     = html_templates["index"].render(
+        {"$COURSE_INDEX": links_str_no, "$SEMESTER": semester})
+    index_eng_html = html_templates["index-eng"].render(
+        {"$COURSE_INDEX": links_str_en, "$SEMESTER": semester})
+
+    write_if_changed(index_html, upload_path+"/index.html")
+    write_if_changed(index_eng_html, upload_path+"/index-eng.html")
+
+# The web build manifest, outputs/.cache/web.json, maps each course page
+# to the fingerprints of its inputs (summary html, stats json, the course's
+# history, templates and scales), and remembers the courses listed in the
+# index pages. Only stale pages are rendered again.
+
+def page_inputs(summary_path, stat_path, history, shared, previous=None):
+    previous = previous or {}
+    inputs = OrderedDict()
+    inputs["summary"] = optional_fingerprint(summary_path, previous.get("summary"))
+    inputs["stats"] = optional_fingerprint(stat_path, previous.get("stats"))
+    inputs["history"] = None if history is None else sha1_text(json_text(history))
+    inputs.update(shared)
+    return inputs
+
+def input_digests(inputs):
+    """Inputs with file fingerprints reduced to their sha1, so touching a
+    file without changing it doesn't make a page stale."""
+    return {key: value["sha1"] if isinstance(value, dict) else value
+            for key, value in inputs.items()}
+
+def page_up_to_date(entry, inputs, output_path):
+    if not entry or "inputs" not in entry:
+        return False
+    if input_digests(entry["inputs"]) != input_digests(inputs):
+        return False
+    return not entry.get("published") or os.path.exists(output_path)
 
-    with open(upload_path+"/index.html", "w") as f:
-        f.write(index_html)
-    with open(upload_path+"/index-eng.html", "w") as f:
-        f.write(index_eng_html)
+def index_inputs(courses, published, html_templates):
+    index = OrderedDict()
+    index["courses"] = [[c, courses[c]["course"]["name"]]
+                        for c in courses if c in published]
+    index["templates"] = [html_templates["index"].digest,
+                          html_templates["index-eng"].digest]
+    return index
+
+def index_up_to_date(entry, index, semester_path):
+    semester = os.path.basename(semester_path)
+    upload_path = semester_path+"/outputs/web/upload/"+semester
+    return (entry == index and
+            os.path.exists(upload_path+"/index.html") and
+            os.path.exists(upload_path+"/index-eng.html"))
+
+class SemesterBuild:
+    """The pages of one semester that need rendering, and its new manifest."""
+    def __init__(self, semester_path, html_templates, courses_all, force=False):
+        self.path = semester_path
+        self.semester = os.path.basename(semester_path)
+        self.courses = load_json(semester_path+"/outputs/courses.json")
+        scales_path = semester_path+"/outputs/scales.json"
+        self.scales = load_compiled_scales(scales_path)
+        self.manifest_path = cache_path(semester_path, "web")
+        self.manifest = OrderedDict() if force else load_json_cache(self.manifest_path)
+
+        old_pages = self.manifest.get("pages", {})
+        shared = OrderedDict()
+        shared["version"] = WEB_VERSION
+        shared["templates"] = [html_templates["NO"].digest, html_templates["EN"].digest]
+        shared["scales"] = file_fingerprint(scales_path)["sha1"]
+
+        self.pages = OrderedDict()
+        self.jobs = []
+        for job in web_report_jobs(semester_path, self.courses):
+            semester, course_code, summary_path, stat_path, output_path = job
+            entry = old_pages.get(course_code)
+            inputs = page_inputs(summary_path, stat_path, courses_all.get(course_code),
+                                 shared, (entry or {}).get("inputs"))
+            if page_up_to_date(entry, inputs, output_path):
+                self.pages[course_code] = entry
+                continue
+            self.pages[course_code] = OrderedDict([("inputs", inputs), ("published", False)])
+            self.jobs.append(job)
+        self.errors = []
+
+    def add_result(self, course_code, published, error):
+        if error:
+            # Left out of the manifest, so it is retried on the next run:
+            del self.pages[course_code]
+            self.errors.append((course_code, error))
+        else:
+            self.pages[course_code]["published"] = published
+
+    def finish(self, html_templates):
+        """Write the index pages if needed, and the new manifest."""
+        published = set(c for c, entry in self.pages.items() if entry["published"])
+        index = index_inputs(self.courses, published, html_templates)
+        if not index_up_to_date(self.manifest.get("index"), index, self.path):
+            web_report_index(self.path, self.courses, published, html_templates)
+        new_manifest = OrderedDict([("pages", self.pages), ("index", index)])
+        dump_json_if_changed(new_manifest, self.manifest_path)
+
+def web_reports_semesters(semester_paths, processes=1, force=False):
+    """Generate the web reports of several semesters in one run.
+
+    The templates and course history are loaded once and, with the compiled
+    scales of every semester, shared by all pages on one worker pool.
+    Returns the number of courses that failed.
+    """
+    html_templates = load_templates()
+    courses_all = load_history("./data")
+
+    builds = OrderedDict()
+    for semester_path in semester_paths:
+        if not os.path.exists(semester_path+"/outputs/courses.json"):
+            print("Warning: skipping {}, it has no outputs/courses.json".format(semester_path))
+            continue
+        build = SemesterBuild(semester_path, html_templates, courses_all, force)
+        builds[build.semester] = build
+
+    jobs = [job for build in builds.values() for job in build.jobs]
+    scales = {semester: build.scales for semester, build in builds.items()}
+    results = run_web_report_jobs(jobs, html_templates, courses_all, scales, processes)
+    for job, (published, error) in zip(jobs, results):
+        semester, course_code = job[:2]
+        builds[semester].add_result(course_code, published, error)
+
+    errors = 0
+    for semester, build in builds.items():
+        build.finish(html_templates)
+        for course_code, error in build.errors:
+            print("Error: could not generate the web report for {} {}:".format(course_code, semester))
+            print(error)
+        errors += len(build.errors)
+    return errors
+
+def web_reports_semester_folder(semester_path, processes=1, force=False):
+    """Generate the course pages and index pages of a semester. Returns the
+    number of courses that failed."""
+    return web_reports_semesters([semester_path], processes, force)
+
+def get_args():
+    argparser = argparse.ArgumentParser(
+                description = "Generate the web reports of a semester")
+    argparser.add_argument("semester_path", help="Semester folder, e.g. data/V2017",
+                           type=str, nargs="?")
+    argparser.add_argument("--all", "-a", action="store_true",
+                           help="Build the web reports of all semesters in ./data")
+    argparser.add_argument("--range", "-r", nargs=2, metavar=("FIRST", "LAST"),
+                           help="Build the web reports of the semesters from"
+                           " FIRST to LAST, e.g. V2009 H2026")
+    argparser.add_argument("--jobs", "-j", default=os.cpu_count() or 1,
+                           help="Number of worker processes", type=int)
+    argparser.add_argument("--force", "-f", action="store_true",
+                           help="Regenerate all pages, ignoring the build manifest")
+    args = argparser.parse_args()
+    if args.all:
+        args.semester_paths = [path_join("./data", s) for s in get_semesters("./data")]
+    elif args.range:
+        args.semester_paths = [path_join("./data", s) for s in semester_range(*args.range)]
+    elif args.semester_path:
+        args.semester_paths = [args.semester_path]
+    else:
+        argparser.error("Specify a semester folder, --all or --range")
+    return args
 
 if __name__ == '__main__':
-    web_reports_semester_folder(sys.argv[1])
+    args = get_args()
+    if web_reports_semesters(args.semester_paths, args.jobs, args.force):
+        sys.exit(1)
@@ -0,0 +1,67 @@
+// Question selection and charts for the course pages made by
+// fui_kk/web_reports.py. The answer counts are read from the json in
+// <script id="chart_data">, see chart_payload() in web_reports.py.
+// A chart is only drawn once its question is shown, and kept afterwards.
+
+var chart_data = JSON.parse(document.getElementById("chart_data").textContent);
+var charts = {};          // chart id -> [chart id, scale index, counts]
+var rendered_charts = {}; // chart id -> true when drawn
+
+for (var i = 0; i < chart_data.charts.length; i++) {
+    charts[chart_data.charts[i][0]] = chart_data.charts[i];
+}
+
+function show_selected_question() {
+    var choice = document.getElementById("select_question").value;
+    var questions = document.querySelectorAll('.question');
+    for (var i = 0; i < questions.length; i++) {
+        questions[i].hidden = true;
+    }
+    document.querySelector('#' + choice).hidden = false;
+    render_visible_charts();
+
+    document.querySelector('#button_show_all_questions').style.display = 'inline';
+    document.querySelector('#button_hide_all_questions').style.display = 'none';
+}
+
+function show_all_questions() {
+    if (!document.querySelector('.question[hidden]')) {
+        show_selected_question();
+        return;
+    }
+    var questions = document.querySelectorAll('.question');
+    for (var i = 0; i < questions.length; i++) {
+        questions[i].hidden = false;
+    }
+    render_visible_charts();
+
+    document.querySelector('#button_show_all_questions').style.display = 'none';
+    document.querySelector('#button_hide_all_questions').style.display = 'inline';
+}
+
+function render_chart(chart_id) {
+    var chart = charts[chart_id];
+    if (!chart || rendered_charts[chart_id]) {
+        return;
+    }
+    var scale = chart_data.scales[chart[1]];
+    var data = [];
+    for (var j = 0; j < scale[0].length; j++) {
+        data.push({ label: scale[0][j], value: chart[2][j] });
+    }
+    insert_chart("#" + chart_id, data, scale[1]);
+    rendered_charts[chart_id] = true;
+}
+
+// Draws the charts of the questions that are shown and not drawn yet. A
+// chart drawn while hidden would get zero width, so hidden ones wait.
+function render_visible_charts() {
+    var questions = document.querySelectorAll('.question');
+    for (var i = 0; i < questions.length; i++) {
+        if (!questions[i].hidden) {
+            render_chart("chart_" + questions[i].id);
+        }
+    }
+}
+
+show_selected_question();
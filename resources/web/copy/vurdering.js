@@ -5,7 +5,8 @@ $(function () {
     'V': 'våren'
   };
   var title_prefix = 'Generell vurdering fra '
-  var avg_score = {
+  // fui_avg_score is generated by fui_kk/score.py (avg_score.js):
+  var avg_score = window.fui_avg_score || {
     'V2009': 4.40,
     'H2009': 4.40,
     'V2010': 4.22,
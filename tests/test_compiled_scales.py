@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import path_fix
+
+import json
+from fui_kk.compiled_scales import compile_scales, load_compiled_scales
+
+def get_scales():
+    return {"Q": {"order": ["Bra", "Greit", "Lite bra", "Dårlig", "Elendig"],
+                  "ignore": ["", "Vet ikke"],
+                  "all": ["", "Vet ikke", "Bra", "Greit", "Lite bra", "Dårlig", "Elendig"]}}
+
+def test_compile_scales():
+    scale = compile_scales(get_scales())["Q"]
+    assert scale.ranked_order == ("Elendig", "Dårlig", "Lite bra", "Greit", "Bra")
+    assert scale.rank["Bra"] == 4
+    assert "Vet ikke" in scale.ignore_set
+    assert scale.colors_js == "['#21428c', '#4573b8', '#c2b59b', '#f7a21c', '#bf2026']"
+
+def test_load_compiled_scales(tmpdir):
+    path = tmpdir.join("scales.json")
+    path.write_text(json.dumps(get_scales()), encoding="utf-8")
+    compiled = load_compiled_scales(str(path))
+    assert "Q" in compiled
+    assert load_compiled_scales(str(path)) is compiled
+    path.write_text(json.dumps({}), encoding="utf-8")
+    assert "Q" not in load_compiled_scales(str(path))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import path_fix
+
+import json
+from collections import OrderedDict
+from fui_kk.file_funcs import dump_columns, columns_path
+from fui_kk.course import (generate_stats, scales_digest, stats_up_to_date,
+                           generate_stats_semesters, generate_stats_file)
+
+def get_scales():
+    scales = OrderedDict()
+    scales["Hva er ditt generelle inntrykk av kurset?"] = {
+        "order": ["Bra", "Greit", "Lite bra"],
+        "ignore": ["", "Vet ikke"],
+        "all": ["", "Vet ikke", "Bra", "Greit", "Lite bra"]
+    }
+    return scales
+
+def test_generate_stats():
+    question = "Hva er ditt generelle inntrykk av kurset?"
+    responses = OrderedDict()
+    responses[question] = ["Greit", "", "Bra", "Bra", "Vet ikke", "Lite bra"]
+    participation = {"started": 7, "answered": 6, "invited": 12}
+    stats = generate_stats(responses, participation, get_scales())
+    assert stats["language"] == "NO"
+    assert stats["answer_percentage"] == 50
+    result = stats["questions"][question]
+    assert list(result["counts"].items()) == [
+        ("Greit", 1), ("", 1), ("Bra", 2), ("Vet ikke", 1), ("Lite bra", 1)]
+    assert result["average"] == (1 + 2 + 2 + 0) / 4
+    assert result["average_text"] == "Greit"
+
+def test_generate_stats_only_ignored():
+    question = "Hva er ditt generelle inntrykk av kurset?"
+    responses = {question: ["", "Vet ikke"]}
+    participation = {"started": 2, "answered": 2, "invited": 0}
+    result = generate_stats(responses, participation, get_scales())["questions"][question]
+    assert result["average"] == "None"
+    assert result["average_text"] == ""
+
+def test_generate_stats_file_free_text_column(tmpdir):
+    # The question was free text when the responses were parsed, and has been
+    # added to scales.json since:
+    question = "Hva er ditt generelle inntrykk av kurset?"
+    responses_path = tmpdir.mkdir("responses").join("INF1000.json")
+    responses_path.write_text("{}", encoding="utf-8")
+    dump_columns({question: ["Greit", "Bra", "Bra"]}, set(),
+                 columns_path(str(responses_path)))
+    participation_path = tmpdir.join("participation.json")
+    participation_path.write_text(json.dumps(
+        {"started": 3, "answered": 3, "invited": 3}), encoding="utf-8")
+    output_path = tmpdir.join("stats.json")
+    questions, written = generate_stats_file(str(responses_path),
+        str(participation_path), str(output_path), get_scales(), {})
+    assert questions == [question] and written
+    result = json.loads(output_path.read_text(encoding="utf-8"))["questions"][question]
+    assert result["counts"] == {"Greit": 1, "Bra": 2}
+
+def test_scales_digest():
+    question = "Hva er ditt generelle inntrykk av kurset?"
+    scales = get_scales()
+    digest = scales_digest(scales, [question, "Unknown"])
+    assert digest == scales_digest(get_scales(), [question, "Unknown"])
+    scales["Other"] = {"order": ["Ja"], "ignore": [], "all": ["Ja"]}
+    # Only the scales of the given questions count:
+    assert digest == scales_digest(scales, [question, "Unknown"])
+    scales[question]["ignore"] = [""]
+    assert digest != scales_digest(scales, [question, "Unknown"])
+
+def test_stats_up_to_date(tmpdir):
+    question = "Hva er ditt generelle inntrykk av kurset?"
+    output = tmpdir.join("stats.json")
+    output.write_text("{}", encoding="utf-8")
+    inputs = {"course": {"code": "INF1000"},
+              "responses": {"sha1": "a"},
+              "participation": {"sha1": "b"}}
+    entry = dict(inputs, questions=[question], written=True,
+                 scales=scales_digest(get_scales(), [question]))
+    assert stats_up_to_date(entry, inputs, get_scales(), str(output))
+    assert not stats_up_to_date(None, inputs, get_scales(), str(output))
+    assert not stats_up_to_date(entry, dict(inputs, responses={"sha1": "c"}),
+                                get_scales(), str(output))
+    assert not stats_up_to_date(entry, dict(inputs, participation=None),
+                                get_scales(), str(output))
+    assert not stats_up_to_date(entry, dict(inputs, course={"code": "INF1010"}),
+                                get_scales(), str(output))
+    scales = get_scales()
+    scales[question]["order"] = ["Greit", "Bra", "Lite bra"]
+    assert not stats_up_to_date(entry, inputs, scales, str(output))
+    output.remove()
+    assert not stats_up_to_date(entry, inputs, get_scales(), str(output))
+
+def test_generate_stats_semesters_missing_scales(tmpdir):
+    question = "Hva er ditt generelle inntrykk av kurset?"
+    for semester in ("V2017", "H2017"):
+        outputs = tmpdir.mkdir(semester).mkdir("outputs")
+        outputs.mkdir("responses").join("INF1000.json").write_text(
+            json.dumps({question: ["Bra", "Greit"]}), encoding="utf-8")
+        tmpdir.join(semester).mkdir("downloads").mkdir("participation").join(
+            "INF1000.json").write_text(
+            json.dumps({"started": 2, "answered": 2, "invited": 4}), encoding="utf-8")
+    tmpdir.join("V2017", "outputs", "scales.json").write_text(
+        json.dumps(get_scales()), encoding="utf-8")
+    names = tmpdir.join("course_names.json")
+    names.write_text('{"INF1000": "Programmering"}', encoding="utf-8")
+
+    semesters = [str(tmpdir.join("V2017")), str(tmpdir.join("H2017"))]
+    assert generate_stats_semesters(semesters, course_names_path=str(names)) == 1
+    assert tmpdir.join("V2017", "outputs", "stats", "INF1000.json").check()
+    assert not tmpdir.join("H2017", "outputs", "stats").check()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import path_fix
+
+import json
+from fui_kk.courses import (update_history, write_history, semester_fingerprints,
+                            CourseHistory, history_shard_path)
+
+def write_semester(data_dir, semester, courses):
+    outputs = data_dir.join(semester, "outputs")
+    outputs.ensure(dir=True)
+    outputs.join("courses.json").write_text(json.dumps(courses), encoding="utf-8")
+
+def test_update_history(tmpdir):
+    write_semester(tmpdir, "V2016", {"INF1000": {"a": 1}, "INF1010": {"a": 2}})
+    write_semester(tmpdir, "V2017", {"INF1000": {"a": 3}})
+    assert update_history(str(tmpdir)) == 2
+    history = CourseHistory(str(tmpdir))
+    assert list(history) == ["INF1000", "INF1010"]
+    assert list(history["INF1000"].items()) == [("V2016", {"a": 1}), ("V2017", {"a": 3})]
+    assert update_history(str(tmpdir)) == 0
+
+    # A semester changes, and a course is removed from it:
+    write_semester(tmpdir, "V2016", {"INF1000": {"a": 4}})
+    assert update_history(str(tmpdir)) == 1
+    history = CourseHistory(str(tmpdir))
+    assert list(history) == ["INF1000"]
+    assert history.semesters("INF1000") == ["V2016", "V2017"]
+    assert history["INF1000"]["V2016"] == {"a": 4}
+    assert not tmpdir.join(".history", "courses", "INF1010.json").check()
+
+    # A semester is removed:
+    tmpdir.join("V2017").remove()
+    assert update_history(str(tmpdir)) == 1
+    history = CourseHistory(str(tmpdir))
+    assert list(history["INF1000"].keys()) == ["V2016"]
+    assert "INF1010" not in history
+    assert history.get("INF1010") is None
+
+def test_write_history_with_fingerprints(tmpdir):
+    write_semester(tmpdir, "V2017", {"INF1000": {"a": 1}})
+    courses = {"INF1000": {"V2017": {"a": 1}}}
+    write_history(courses, str(tmpdir), semester_fingerprints(str(tmpdir), ["V2017"]))
+    # The semester is known, so nothing is merged again:
+    assert update_history(str(tmpdir)) == 0
+    assert CourseHistory(str(tmpdir)).load() == courses
@@ -3,7 +3,10 @@
 import path_fix
 
 # Test that all modules can be imported:
-from fui_kk.file_funcs import path_join, path_clean
+from collections import OrderedDict
+import sys
+from fui_kk.file_funcs import (path_join, path_clean, dump_columns, load_columns,
+                               run_jobs)
 
 def test_path_join():
     assert path_join("a", "b",   "e") == "a/b/e"
@@ -13,3 +16,39 @@ def test_path_clean():
     assert path_clean("INF****") == "INFXXXX"
     assert path_clean("INF1234 - Being cool") == "INF1234_-_Being_cool"
     assert path_clean("* * * *") == "X_X_X_X"
+
+def test_columns_round_trip(tmpdir):
+    responses = OrderedDict()
+    responses["Scaled"] = ["Bra", "", "Særdeles bra", "Bra"]
+    responses["Text"] = ["Fint kurs", "", "ÆØÅ\ttab", "x"]
+    path = str(tmpdir.join("columns", "INF1000.columns"))
+    assert dump_columns(responses, {"Scaled"}, path)
+    assert not dump_columns(responses, {"Scaled"}, path)
+    with load_columns(path) as store:
+        assert store.questions() == ["Scaled", "Text"]
+        assert store.respondents == 4
+        assert store.is_scaled("Scaled") and not store.is_scaled("Text")
+        assert store.vocabulary("Scaled") == ["Bra", "", "Særdeles bra"]
+        assert list(store.codes("Scaled")) == [0, 1, 2, 0]
+        assert store.vocabulary("Text") == responses["Text"]
+        assert store.to_dict() == responses
+
+def check_job(job):
+    if job == "exit":
+        sys.exit(1)
+    if job == "expected":
+        raise KeyError("expected")
+    if job == "error":
+        raise ValueError("unexpected")
+    return job.upper()
+
+def test_run_jobs():
+    jobs = ["a", "exit", "expected", "error", "b"]
+    for processes in (1, 3):
+        results = run_jobs(check_job, jobs, processes, expected=(KeyError,))
+        assert [r for r, e in results] == ["A", None, None, None, "B"]
+        errors = [e for r, e in results]
+        assert errors[0] is None and errors[4] is None
+        assert errors[1] == "exited with status 1"
+        assert errors[2] == "'expected'"
+        assert "ValueError: unexpected" in errors[3]
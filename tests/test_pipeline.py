@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import path_fix
+
+import json
+from fui_kk.responses import parse_tsv_files
+from fui_kk.course import generate_stats_semesters
+from fui_kk import semester
+from fui_kk.courses import load_semesters, merge_semesters
+from fui_kk.pipeline import build_all
+
+QUESTION = "Hva er ditt generelle inntrykk av kurset?"
+SCALES = {QUESTION: {"order": ["Bra", "Greit", "Lite bra"],
+                     "ignore": ["", "Vet ikke"],
+                     "all": ["", "Vet ikke", "Bra", "Greit", "Lite bra"]}}
+
+def make_data(data_dir):
+    tsv = {"V2016": {"INF1000": ["Bra", "Greit", "Bra", "Vet ikke", "Lite bra"]},
+           "V2017": {"INF1000": ["Greit", "Greit", "Bra", "Bra", "Bra"],
+                     "INF1010": ["Lite bra", "", "Greit", "Bra", "Greit"]}}
+    for semester_name, courses in tsv.items():
+        semester_dir = data_dir.mkdir(semester_name)
+        tsv_dir = semester_dir.mkdir("downloads").mkdir("tsv")
+        participation_dir = semester_dir.join("downloads").mkdir("participation")
+        outputs = semester_dir.mkdir("outputs")
+        outputs.join("scales.json").write_text(json.dumps(SCALES), encoding="utf-8")
+        for course, answers in courses.items():
+            rows = [QUESTION + "\tKommentar"]
+            rows.extend(a + "\tFint kurs" for a in answers)
+            tsv_dir.join(course + ".tsv").write_text("\n".join(rows) + "\n", encoding="utf-8")
+            participation_dir.join(course + ".json").write_text(json.dumps(
+                {"started": len(answers), "answered": len(answers), "invited": 10}),
+                encoding="utf-8")
+    names = data_dir.join("course_names.json")
+    names.write_text('{"INF1000": "Programmering", "INF1010": "Objektorientert"}',
+                     encoding="utf-8")
+    return str(names)
+
+def test_build_all_matches_separate_steps(tmpdir):
+    separate = tmpdir.mkdir("separate")
+    names = make_data(separate)
+    semester_dirs = [str(separate.join(s)) for s in ("V2016", "V2017")]
+    for semester_dir in semester_dirs:
+        parse_tsv_files(semester_dir + "/downloads/tsv", semester_dir + "/outputs/responses",
+                        scales_path=semester_dir + "/outputs/scales.json")
+    assert generate_stats_semesters(semester_dirs, course_names_path=names) == 0
+    for semester_dir in semester_dirs:
+        semester.main(semester_dir)
+    expected = merge_semesters(load_semesters(str(separate)))
+
+    fused = tmpdir.mkdir("fused")
+    names = make_data(fused)
+    courses, errors, semesters = build_all(str(fused), course_names_path=names)
+    assert errors == []
+    assert semesters == ["V2016", "V2017"]
+    assert json.dumps(courses) == json.dumps(expected)
+    assert list(courses) == ["INF1000", "INF1010"]
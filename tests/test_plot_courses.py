@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import path_fix
+
+import json
+import copy
+from collections import OrderedDict
+from fui_kk.compiled_scales import compile_scales
+from fui_kk.courses import semester_range
+from fui_kk.plot_courses import plot_course, generate_plots
+
+QUESTION = "Hva er ditt generelle inntrykk av kurset?"
+
+def get_scales():
+    return {QUESTION: {"order": ["Bra", "Greit", "Lite bra"],
+                       "ignore": [""],
+                       "all": ["", "Bra", "Greit", "Lite bra"]}}
+
+def course_semester(average):
+    return OrderedDict([("language", "NO"), (QUESTION, {"average": average})])
+
+def get_courses():
+    courses = OrderedDict()
+    for code, averages in (("INF1000", (1.0, 1.5)), ("INF1010", (2.0, 1.0))):
+        courses[code] = OrderedDict(zip(("V2016", "H2016"),
+                                        map(course_semester, averages)))
+    return courses
+
+def make_data(tmpdir, semesters):
+    """data/<semester>/outputs with scales.json and courses.json, for the
+    semesters in semesters (the others only get an empty folder)."""
+    courses = get_courses()
+    for semester in ("V2015", "H2015", "V2016", "H2016"):
+        outputs = tmpdir.join("data", semester, "outputs").ensure(dir=True)
+        if semester not in semesters:
+            continue
+        outputs.join("scales.json").write_text(json.dumps(get_scales()), encoding="utf-8")
+        semester_data = {c: history[semester] for c, history in courses.items()}
+        outputs.join("courses.json").write_text(json.dumps(semester_data), encoding="utf-8")
+
+def plotted(capsys):
+    out = capsys.readouterr().out
+    return sorted(line.split("/")[-1] for line in out.splitlines()
+                  if line.startswith("Generated plot: "))
+
+def test_generate_plots_incremental(tmpdir, monkeypatch, capsys):
+    make_data(tmpdir, ["H2016"])
+    monkeypatch.chdir(tmpdir)
+    courses = get_courses()
+    assert generate_plots(courses, ["H2016"]) == 0
+    assert plotted(capsys) == ["INF1000.pdf", "INF1010.pdf"]
+    plots = tmpdir.join("data", "H2016", "outputs", "plots")
+    assert plots.join("INF1000.png").check() and plots.join("INF1010.png").check()
+
+    assert generate_plots(courses, ["H2016"]) == 0
+    assert plotted(capsys) == []
+
+    courses["INF1000"]["V2016"][QUESTION]["average"] = 0.5
+    assert generate_plots(courses, ["H2016"]) == 0
+    assert plotted(capsys) == ["INF1000.pdf"]
+
+def test_generate_plots_backfill(tmpdir, monkeypatch, capsys):
+    make_data(tmpdir, ["V2016", "H2016"])
+    monkeypatch.chdir(tmpdir)
+    courses = get_courses()
+    before = copy.deepcopy(courses)
+    semesters = semester_range("V2015", "H2016")
+    assert semesters == ["V2015", "H2015", "V2016", "H2016"]
+    assert generate_plots(courses, semesters) == 0
+    out = capsys.readouterr().out
+    assert "Warning: skipping V2015" in out and "Warning: skipping H2015" in out
+    for semester in ("V2016", "H2016"):
+        assert tmpdir.join("data", semester, "outputs", "plots", "INF1000.pdf").check()
+    assert not tmpdir.join("data", "V2015", "outputs", "plots").check()
+    assert courses == before
+
+def test_plot_course_key(tmpdir):
+    courses = get_courses()
+    scales = compile_scales(get_scales())
+    output = str(tmpdir) + "/"
+    key = plot_course("INF1000", courses, output, scales, "H2016")
+    assert key is not None
+    assert plot_course("INF1000", courses, output, scales, "H2016", key) == key
+    assert plot_course("INF1000", get_courses(), output, scales, "H2016") == key
+    assert plot_course("INF1000", courses, output, scales, "V2016") != key
+    assert plot_course("INF1010", courses, output, scales, "H2016") != key
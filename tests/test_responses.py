@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import path_fix
+
+from fui_kk.responses import parse_course_tsv, parse_tsv_files
+from fui_kk.file_funcs import load_json, load_columns
+
+def write_tsv(tmpdir, content):
+    path = tmpdir.join("course.tsv")
+    path.write_text(content, encoding="utf-8")
+    return str(path)
+
+def test_parse_course_tsv(tmpdir):
+    path = write_tsv(tmpdir, "A\tB\nBra\tx\nGreit\ty\n")
+    responses = parse_course_tsv(path)
+    assert list(responses.keys()) == ["A", "B"]
+    assert responses["A"] == ["Bra", "Greit"]
+    assert responses["B"] == ["x", "y"]
+
+def test_parse_course_tsv_ragged(tmpdir):
+    path = write_tsv(tmpdir, "A\tB\tC\nBra\nGreit\ty\tz\textra\n\n")
+    responses = parse_course_tsv(path)
+    assert responses["A"] == ["Bra", "Greit"]
+    assert responses["B"] == ["", "y"]
+    assert responses["C"] == ["", "z"]
+
+def test_parse_course_tsv_empty(tmpdir):
+    assert parse_course_tsv(write_tsv(tmpdir, "")) == {}
+
+def test_parse_tsv_files_skips_unchanged(tmpdir):
+    tsv_dir = tmpdir.mkdir("tsv")
+    tsv_dir.join("INF1000.tsv").write_text("A\nBra\n", encoding="utf-8")
+    output_dir = str(tmpdir.join("responses"))
+    manifest = str(tmpdir.join("manifest.json"))
+    parse_tsv_files(str(tsv_dir), output_dir, manifest)
+    output = tmpdir.join("responses", "INF1000.json")
+    assert output.check()
+    assert tmpdir.join("columns", "INF1000.columns").check()
+    output.write_text("untouched", encoding="utf-8")
+    parse_tsv_files(str(tsv_dir), output_dir, manifest)
+    assert output.read_text("utf-8") == "untouched"
+    parse_tsv_files(str(tsv_dir), output_dir, manifest, force=True)
+    assert output.read_text("utf-8") != "untouched"
+
+def test_parse_tsv_files_splits_free_text(tmpdir):
+    tsv_dir = tmpdir.mkdir("tsv")
+    tsv_dir.join("INF1000.tsv").write_text("Scaled\tText\nBra\tFint\n",
+                                           encoding="utf-8")
+    scales = tmpdir.join("scales.json")
+    scales.write_text('{"Scaled": {}}', encoding="utf-8")
+    parse_tsv_files(str(tsv_dir), str(tmpdir.join("responses")),
+                    scales_path=str(scales))
+    responses_path = str(tmpdir.join("responses", "INF1000.json"))
+    assert load_json(responses_path) == {"Scaled": ["Bra"]}
+    assert not tmpdir.join("free_text").check()
+    with load_columns(str(tmpdir.join("columns", "INF1000.columns"))) as store:
+        assert store.questions() == ["Scaled", "Text"]
+        assert store.is_scaled("Scaled")
+        assert store.answers("Text") == ["Fint"]
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import path_fix
+
+import sys
+import json
+import builtins
+import pytest
+from collections import OrderedDict
+from fui_kk.file_funcs import dump_columns, columns_path
+from fui_kk.scales import (scales_add_course, error_check, course_vocabulary,
+                           semester_vocabularies, main)
+
+def test_scales_add_course(tmpdir):
+    path = tmpdir.join("INF1000.json")
+    path.write_text(json.dumps({"Q": ["bra", "", "Bra", "greit"], "Other": ["x"]}),
+                    encoding="utf-8")
+    scales = OrderedDict()
+    scales["Q"] = OrderedDict([("order", ["Bra"]), ("all", ["Bra"]), ("ignore", [])])
+    seen = {}
+    scales_add_course(str(path), scales, seen)
+    scales_add_course(str(path), scales, seen)
+    assert scales["Q"]["all"] == ["Bra", "", "Greit"]
+    assert "Other" not in scales
+
+def test_error_check():
+    scales = OrderedDict()
+    scales["Ok"] = {"all": ["", "Bra"], "order": ["Bra"], "ignore": [""]}
+    scales["Broken"] = {"all": ["", "Bra", "Greit"], "order": ["Bra", "Grei"],
+                        "ignore": ["", "Bra"]}
+    errors = error_check(scales)
+    assert list(errors.keys()) == ["Broken"]
+    assert errors["Broken"] == [
+        "all != order + ignore, you should copy the answers from all into order/ignore.",
+        '"Bra" cannot be in both order and ignore.',
+        '"Greit" must be in either order or ignore.',
+        '"Grei" is in order but not in all, typo?']
+
+def test_course_vocabulary_skips_free_text(tmpdir):
+    path = tmpdir.mkdir("responses").join("INF1000.json")
+    path.write_text(json.dumps({"Q": ["Bra", "Bra"]}), encoding="utf-8")
+    dump_columns({"Q": ["Bra", "Bra"], "Text": ["Fint", "Kjedelig"]}, {"Q"},
+                 columns_path(str(path)))
+    assert course_vocabulary(str(path)) == {"Q": ["Bra"]}
+    assert course_vocabulary(str(path), ["Text"]) == {"Q": ["Bra"],
+                                                      "Text": ["Fint", "Kjedelig"]}
+
+def test_semester_vocabularies_new_scaled_question(tmpdir):
+    # "Text" was free text when the responses were parsed, it is added to
+    # scales.json afterwards:
+    path = tmpdir.mkdir("outputs").mkdir("responses").join("INF1000.json")
+    path.write_text(json.dumps({"Q": ["Bra"]}), encoding="utf-8")
+    dump_columns({"Q": ["Bra"], "Text": ["Fint"]}, {"Q"}, columns_path(str(path)))
+    assert semester_vocabularies(str(tmpdir)) == {"INF1000.json": {"Q": ["Bra"]}}
+    vocabularies = semester_vocabularies(str(tmpdir), ["Q", "Text"])
+    assert vocabularies == {"INF1000.json": {"Q": ["Bra"], "Text": ["Fint"]}}
+    # Only the scaled questions are cached:
+    assert semester_vocabularies(str(tmpdir)) == {"INF1000.json": {"Q": ["Bra"]}}
+
+def test_batch_mode(tmpdir, monkeypatch):
+    outputs = tmpdir.mkdir("data").mkdir("V2017").mkdir("outputs")
+    scales = OrderedDict()
+    scales["Q"] = OrderedDict([("order", []), ("all", []), ("ignore", [])])
+    scales["Other"] = OrderedDict([("order", ["Bra"]), ("all", ["Bra"]), ("ignore", [])])
+    outputs.join("scales.json").write_text(json.dumps(scales), encoding="utf-8")
+    outputs.mkdir("responses").join("INF1000.json").write_text(json.dumps(
+        {"Q": ["Bra", "Vet ikke"], "Other": ["Bra", "Rart"]}), encoding="utf-8")
+
+    def no_input(*args):
+        raise AssertionError("batch mode must not ask")
+    monkeypatch.setattr(builtins, "input", no_input)
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(sys, "argv", ["scales.py", "--batch", "--jobs", "1", "V2017"])
+    with pytest.raises(SystemExit) as e:
+        main()
+    assert e.value.code == 1
+
+    review = json.loads(outputs.join("scales_review.json").read_text(encoding="utf-8"))
+    assert review["semester"] == "V2017"
+    assert [r["question"] for r in review["autofilled"]] == ["Q"]
+    assert review["autofilled"][0]["after"]["order"] == ["Bra"]
+    assert review["autofilled"][0]["after"]["ignore"] == ["Vet ikke"]
+    assert list(review["errors"]) == ["Other"]
+    written = json.loads(outputs.join("scales.json").read_text(encoding="utf-8"))
+    assert written["Q"]["order"] == ["Bra"]
+    assert written["Other"]["all"] == ["Rart", "Bra"]
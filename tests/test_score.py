@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import path_fix
+
+from collections import OrderedDict
+from fui_kk.score import semester_averages, score_js
+
+QUESTION = "Hva er ditt generelle inntrykk av kurset?"
+
+def course_data(average, answered):
+    return {QUESTION: {"average": average}, "respondents": {"answered": answered}}
+
+def get_courses():
+    courses = OrderedDict()
+    courses["INF1000"] = OrderedDict([("V2017", course_data(4.0, 30)),
+                                      ("H2016", course_data(3.0, 10))])
+    courses["INF1010"] = OrderedDict([("V2017", course_data(2.0, 10)),
+                                      ("H2016", course_data("None", 5))])
+    courses["INF2220"] = OrderedDict([("V2017", {"respondents": {"answered": 3}})])
+    return courses
+
+def test_semester_averages():
+    averages = semester_averages(get_courses())
+    assert list(averages.items()) == [("H2016", 3.0), ("V2017", 3.0)]
+
+def test_semester_averages_weighted():
+    averages = semester_averages(get_courses(), weighted=True)
+    assert list(averages.items()) == [("H2016", 3.0), ("V2017", 3.5)]
+
+def test_semester_averages_empty():
+    assert semester_averages({}) == {}
+
+def test_score_js():
+    js = score_js(OrderedDict([("V2017", 3.5)]))
+    assert "var fui_avg_score = {" in js
+    assert '"V2017": 4.5' in js
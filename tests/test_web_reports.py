@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import path_fix
+
+import json
+from fui_kk.compiled_scales import compile_scales
+from fui_kk.web_reports import Template, page_inputs, page_up_to_date, chart_payload
+
+def test_template_render():
+    template = Template("<h1>$COURSE_CODE - $COURSE_NAME</h1>$MAIN_BODY $UNKNOWN")
+    html = template.render({"$COURSE_CODE": "INF1000",
+                            "$COURSE_NAME": "Programmering",
+                            "$MAIN_BODY": "Costs $COURSE_CODE"})
+    assert html == "<h1>INF1000 - Programmering</h1>Costs $COURSE_CODE $UNKNOWN"
+
+def test_page_up_to_date(tmpdir):
+    summary = tmpdir.join("INF1000.html")
+    summary.write_text("<p>Bra</p>", encoding="utf-8")
+    output = tmpdir.join("out.html")
+    output.write_text("", encoding="utf-8")
+    stats = str(tmpdir.join("missing.json"))
+    shared = {"version": 1, "templates": ["a", "b"], "scales": "c"}
+
+    inputs = page_inputs(str(summary), stats, {"V2017": {}}, shared)
+    entry = {"inputs": inputs, "published": True}
+    assert page_up_to_date(entry, page_inputs(str(summary), stats, {"V2017": {}}, shared), str(output))
+    assert not page_up_to_date(entry, page_inputs(str(summary), stats, {"H2017": {}}, shared), str(output))
+    summary.write_text("<p>Dårlig</p>", encoding="utf-8")
+    assert not page_up_to_date(entry, page_inputs(str(summary), stats, {"V2017": {}}, shared), str(output))
+
+def test_chart_payload():
+    scales = compile_scales({"Q": {"order": ["Bra", "Greit", "Lite bra", "Dårlig", "Elendig"],
+                                   "ignore": [""], "all": []}})
+    questions = {"Q": {"counts": {"Bra": 3, "Elendig": 1}}}
+    payload = json.loads(chart_payload(questions, scales, {"Q": "chart_q"}))
+    assert payload["charts"] == [["chart_q", 0, [3, 0, 0, 0, 1]]]
+    assert payload["scales"][0][0] == ["Bra", "Greit", "Lite bra", "Dårlig", "Elendig"]
+    assert len(payload["scales"][0][1]) == 5